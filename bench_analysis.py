@@ -0,0 +1,79 @@
+"""
+benchmark of the analysis tools on growing numbers of synthetic nights (see
+synthetic_nights.py): parsing with and without the cache, building the
+archive, staging and plotting
+"""
+
+import time
+import tempfile
+from pathlib import Path
+from itertools import islice
+from fire import Fire
+import matplotlib
+matplotlib.use("Agg")
+
+from synthetic_nights import generate_nights
+from night_loader import load_night
+from night_archive import NightArchive
+from sleep_staging import stage_nights
+import plotter
+
+
+def _timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def bench(sizes=(10, 100, 1000),
+          hours=8,
+          short_rate=0.02,
+          max_plots=20,
+          seed=0,
+          ):
+    """
+    print the time taken by each step of the analysis for each number of
+    nights
+
+    Parameters
+    ----------
+    sizes: list, default (10, 100, 1000)
+        numbers of nights to benchmark, for example 10,100,1000,10000
+    hours: float, default 8
+        duration of each night
+    short_rate: float, default 0.02
+        fraction of nights too short to be kept by the plotter
+    max_plots: int, default 20
+        at most that many nights are plotted for each size, the time per
+        plot does not depend on the number of nights
+    seed: int, default 0
+    """
+    if isinstance(sizes, int):
+        sizes = [sizes]
+    results = []
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            files = generate_nights(tmp, n_nights=n, hours=hours, short_rate=short_rate, seed=seed)
+            r = {"nights": n}
+            r["parse"] = _timed(lambda: [load_night(f) for f in files])
+            r["cache write"] = _timed(lambda: [load_night(f, cache=True) for f in files])
+            r["cache read"] = _timed(lambda: [load_night(f, cache=True) for f in files])
+
+            archive_dir = Path(tmp) / "archive"
+            r["archive"] = _timed(lambda: NightArchive(archive_dir).update(tmp))
+            archive = NightArchive(archive_dir)
+            r["stage"] = _timed(stage_nights, archive_dir, list(range(len(archive))))
+
+            sample = list(islice((f for f in files if len(load_night(f, cache=True)) > 5), max_plots))
+            duration = _timed(lambda: [plotter._process_file(f, Path(tmp), "saveimg", True, 150, None) for f in sample])
+            r["plot/night"] = duration / max(len(sample), 1)
+            results.append(r)
+
+    columns = ["parse", "cache write", "cache read", "archive", "stage", "plot/night"]
+    print("\n\nseconds   " + "".join(f"{c:>13}" for c in columns))
+    for r in results:
+        print(f"{r['nights']:>6}    " + "".join(f"{r[c]:>13.3f}" for c in columns))
+
+
+if __name__ == "__main__":
+    Fire(bench)
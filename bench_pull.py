@@ -0,0 +1,135 @@
+"""
+benchmark of the pull pipeline of pull_sleep_data.py against a simulated
+watch, to measure transfer optimizations without a pinetime
+"""
+
+import time
+import shutil
+import tempfile
+import zlib
+from pathlib import Path
+from fire import Fire
+
+from pull_sleep_data import download_sleep_data
+from watch_transport import FakeWatchTransport
+from synthetic_nights import generate_nights
+
+# settings of the simulated watch for each scenario, on top of the link
+# settings given to bench()
+SCENARIOS = {
+        "clean": {},
+        "clean_compressed": {"compress": True},
+        "fragmented_heap": {"max_alloc": 512},
+        "flaky": {"error_rate": 0.05},
+        "flaky_compressed": {"error_rate": 0.05, "compress": True},
+        }
+
+
+def make_backlog(directory, n_nights, hours, seed=0):
+    """write n_nights sleep logs looking like the ones of SleepTk (version
+    1, saved every 120s) into directory"""
+    generate_nights(directory, n_nights=n_nights, hours=hours, seed=seed)
+
+
+def run_scenario(backlog, name, compress=False, max_chunk_size=2048, **watch_settings):
+    """pull a copy of backlog from a simulated watch, returns a dict of
+    measurements"""
+    with tempfile.TemporaryDirectory() as tmp:
+        remote = Path(tmp) / "remote"
+        local = Path(tmp) / "local"
+        shutil.copytree(backlog, remote)
+        expected = {f.name: zlib.adler32(f.read_bytes()) for f in remote.iterdir()}
+        watch = FakeWatchTransport(remote, **watch_settings)
+
+        start = time.perf_counter()
+        puller = None
+        try:
+            puller = download_sleep_data(
+                local_dir=str(local),
+                compress=compress,
+                max_chunk_size=max_chunk_size,
+                notify=False,
+                transport=lambda device: watch,
+                device=name,
+            )
+        except SystemExit:
+            pass
+        duration = time.perf_counter() - start
+
+        # the local directory also holds the pull index and statistics
+        pulled = {f.name: zlib.adler32(f.read_bytes()) for f in local.glob("*.csv")}
+        n_bytes = sum(f.stat().st_size for f in local.glob("*.csv"))
+        return {
+                "scenario": name,
+                "seconds": duration,
+                "bytes": n_bytes,
+                "bytes/s": n_bytes / duration if duration else 0,
+                "link bytes": watch.bytes_sent,
+                "calls": watch.calls,
+                "retries": puller.retries if puller is not None else None,
+                "complete": pulled == expected and not any(remote.iterdir()),
+                }
+
+
+def bench(n_nights=14,
+          hours=8,
+          latency=0.1,
+          throughput=10000,
+          mem_free=20000,
+          max_chunk_size=2048,
+          scenarios=None,
+          seed=0,
+          ):
+    """
+    pull a realistic backlog of nights from a simulated watch in several
+    scenarios and print the end-to-end time, throughput and retries
+
+    Parameters
+    ----------
+    n_nights: int, default 14
+        number of nights in the backlog
+    hours: int, default 8
+        duration of each night
+    latency: float, default 0.1
+        seconds spent by the simulated watch on every call
+    throughput: int, default 10000
+        bytes per second sent back by the simulated watch
+    mem_free: int, default 20000
+        free memory reported by the simulated watch
+    max_chunk_size: int, default 2048
+        passed to download_sleep_data
+    scenarios: list, default None
+        names of the scenarios to run, among the keys of SCENARIOS. None
+        to run all of them.
+    seed: int, default 0
+        seed used to generate the nights and the simulated errors
+    """
+    scenarios = scenarios or list(SCENARIOS.keys())
+    if isinstance(scenarios, str):
+        scenarios = [scenarios]
+    for s in scenarios:
+        assert s in SCENARIOS, f"Unknown scenario '{s}'"
+
+    results = []
+    with tempfile.TemporaryDirectory() as backlog:
+        make_backlog(backlog, n_nights, hours, seed)
+        for s in scenarios:
+            settings = dict(SCENARIOS[s])
+            results.append(run_scenario(
+                backlog,
+                s,
+                compress=settings.pop("compress", False),
+                max_chunk_size=max_chunk_size,
+                latency=latency,
+                throughput=throughput,
+                mem_free=mem_free,
+                seed=seed,
+                **settings))
+
+    print("\n\nscenario              seconds    bytes/s  link bytes  calls  retries  complete")
+    for r in results:
+        print(f"{r['scenario']:<20} {r['seconds']:>8.2f} {r['bytes/s']:>10.0f} {r['link bytes']:>11} {r['calls']:>6} {str(r['retries']):>8}  {r['complete']}")
+
+
+if __name__ == "__main__":
+    Fire(bench)
@@ -0,0 +1,275 @@
+"""
+micro benchmarks of the code of sleep_tk.py that runs the most often on the
+watch, run under CPython with the stubs of sleep_tk_replay.py. For each
+path the time per call and the memory allocated per call (measured with
+tracemalloc) are reported and can be compared to a stored baseline to
+catch regressions before they reach the watch.
+
+The absolute numbers say little about the watch, but their evolution from
+one version of sleep_tk.py to the next does. The times are also given
+relative to a reference loop run on the same computer, these relative
+times are the ones stored in the baseline and compared by --check so that
+the baseline of the repository can be used on any computer.
+
+The subtick benchmark runs the heart rate processing of wasp-os, it is only
+available when the 'wasp' directory of wasp-os is in the python path, for
+example with PYTHONPATH=../wasp-os/wasp.
+"""
+
+import gc
+import sys
+import json
+import math
+import time
+import tempfile
+import tracemalloc
+from array import array
+from pathlib import Path
+from types import ModuleType
+from fire import Fire
+
+from sleep_tk_replay import SimulatedWatch, synthetic_accel, synthetic_heart_rate
+
+# stored next to this file, so that --check works from any directory
+BASELINE_NAME = str(Path(__file__).parent / "bench_sleep_tk_baseline.json")
+
+# calls right before measuring the memory, enough for CPython to fill its
+# lists of freed objects kept for reuse (up to 2000 tuples of each size),
+# which gc.collect empties and would otherwise count as kept bytes
+_WARM_UP = 3000
+
+# the times are measured that many times and the fastest is kept
+_REPEAT = 5
+
+
+def _wasp_ppg():
+    """ppg.PPG of wasp-os if it can be imported, with a stand-in for the
+    micropython module, None otherwise"""
+    micropython = ModuleType("micropython")
+    micropython.const = lambda value: value
+    micropython.native = micropython.viper = lambda f: f
+    saved = sys.modules.get("micropython")
+    sys.modules.setdefault("micropython", micropython)
+    try:
+        from ppg import PPG
+        PPG(24).preprocess(0)
+        return PPG
+    except Exception:
+        return None
+    finally:
+        if saved is None:
+            sys.modules.pop("micropython", None)
+
+
+def _tracking_app(root):
+    "an app that just started tracking with every feature enabled"
+    watch = SimulatedWatch(root, 1700002800, synthetic_accel(0), synthetic_heart_rate(0))
+    sleep_tk = watch.load_app_module()
+    app = sleep_tk.SleepTkApp()
+    app.foreground()
+    app._state_alarm = 1
+    app._state_spinval_H, app._state_spinval_M = 7, 0
+    app._state_body_tracking = 1
+    app._state_HR_tracking = 1
+    app._state_gradual_wake = 1
+    app._start_tracking()
+    watch.sleep()
+    return watch, app, sleep_tk
+
+
+def _track_once(watch, app, sleep_tk):
+    "one accelerometer sample, saving every _STORE_FREQ seconds like at night"
+    def call():
+        watch.clock.now += sleep_tk._FREQ
+        app._trackOnce()
+        watch.alarms.clear()
+        # the heart rate is measured by tick, not benchmarked here
+        app._track_HR_once = 0
+        watch.tick_period = None
+    return call
+
+
+def _periodic_save(watch, app, sleep_tk):
+    "a save of the accumulated data to the log"
+    def call():
+        watch.clock.now += sleep_tk._STORE_FREQ
+        app._data_point_nb = app._last_checkpoint + sleep_tk._STORE_FREQ // sleep_tk._FREQ
+        app._track_HR_once = 0
+        app._last_HR = 60
+        app._periodicSave()
+    return call
+
+
+def _subtick(watch, app, sleep_tk):
+    "one heart rate sample processed by ppg.PPG of wasp-os"
+    PPG = _wasp_ppg()
+
+    def call():
+        if app._hrdata is None or len(app._hrdata.data) >= 240:
+            app._hrdata = PPG(watch.modules["wasp"].watch.hrs.read_hrs())
+        app._subtick()
+    return call
+
+
+def _draw(watch, app, sleep_tk):
+    "a redraw of the tracking screen"
+    def call():
+        watch.clock.now += 1
+        app._draw()
+    return call
+
+
+BENCHMARKS = {
+        "trackOnce": _track_once,
+        "periodicSave": _periodic_save,
+        "draw": _draw,
+        }
+if _wasp_ppg() is not None:
+    BENCHMARKS["subtick"] = _subtick
+
+
+def _reference(n=10):
+    """fixed mix of the float arithmetic, array indexing and method calls
+    found in sleep_tk.py, whose time is the unit of the relative times"""
+    buff = array("f", (0, 0, 0))
+    values = []
+    for i in range(n):
+        x = math.atan(i * 0.001 / math.sqrt((i * 0.002) ** 2 + 0.00001))
+        buff[i % 3] += x
+        values.append("{:.3f}".format(x))
+        if len(values) > 10:
+            values.clear()
+
+
+def _best_us_per_call(call, calls):
+    "fastest of _REPEAT measures of the microseconds per call"
+    best = float("inf")
+    for _ in range(_REPEAT):
+        gc.collect()
+        start = time.perf_counter()
+        for _ in range(calls):
+            call()
+        best = min(best, (time.perf_counter() - start) / calls * 1e6)
+    return best
+
+
+def reference_us():
+    "microseconds taken by _reference on this computer"
+    return _best_us_per_call(_reference, 2000)
+
+
+def measure(name, calls=2000, reference=None):
+    """returns the microseconds per call, the same divided by reference (see
+    reference_us), the peak bytes allocated during a call and the bytes
+    kept after each call on average"""
+    reference = reference or reference_us()
+    with tempfile.TemporaryDirectory() as root:
+        call = BENCHMARKS[name](*_tracking_app(root))
+        for _ in range(10):
+            call()
+        us_per_call = _best_us_per_call(call, calls)
+
+        for _ in range(_WARM_UP):
+            call()
+
+        # tracemalloc slows everything down so it is measured separately
+        tracemalloc.start()
+        peaks = 0
+        before, _ = tracemalloc.get_traced_memory()
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            call()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks += peak - current
+        after, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {"us_per_call": us_per_call,
+            "relative_time": us_per_call / reference,
+            "peak_bytes_per_call": peaks / calls,
+            "kept_bytes_per_call": (after - before) / calls}
+
+
+def bench(calls=None,
+          benchmarks=None,
+          save_baseline=False,
+          check=False,
+          baseline=BASELINE_NAME,
+          time_threshold=1.5,
+          memory_threshold=1.2,
+          ):
+    """
+    run the micro benchmarks of sleep_tk.py and print the results
+
+    Parameters
+    ----------
+    calls: int, default None
+        number of calls of each benchmarked path, None to use the number
+        stored in the baseline with --check and 2000 otherwise
+    benchmarks: list, default None
+        names of the benchmarks to run among the keys of BENCHMARKS, None
+        for all of them
+    save_baseline: bool, default False
+        if True, store the results as the new baseline
+    check: bool, default False
+        if True, compare the results to the baseline and exit with an error
+        if a path got slower or allocates more than allowed
+    baseline: str, default bench_sleep_tk_baseline.json next to this file
+        path of the baseline
+    time_threshold: float, default 1.5
+        maximum ratio of the relative time per call compared to the
+        baseline
+    memory_threshold: float, default 1.2
+        maximum ratio of the bytes allocated per call compared to the
+        baseline
+    """
+    benchmarks = benchmarks or list(BENCHMARKS.keys())
+    if isinstance(benchmarks, str):
+        benchmarks = [benchmarks]
+    for b in benchmarks:
+        assert b in BENCHMARKS, f"Unknown benchmark '{b}'" + (
+                ", the 'wasp' directory of wasp-os has to be in the python path" if b == "subtick" else "")
+
+    if check:
+        assert Path(baseline).exists(), f"No baseline found at '{baseline}', run with --save_baseline first"
+        reference = json.loads(Path(baseline).read_text())
+        assert "calls" in reference, f"'{baseline}' is outdated, run with --save_baseline again"
+        # the bytes kept per call depend on the number of calls
+        calls = calls or reference["calls"]
+        if calls != reference["calls"]:
+            print(f"Warning: the baseline was measured with {reference['calls']} calls, not {calls}")
+    calls = calls or 2000
+
+    unit = reference_us()
+    results = {b: measure(b, calls, unit) for b in benchmarks}
+    print(f"{'benchmark':<14} {'us/call':>9} {'relative':>9} {'peak B/call':>12} {'kept B/call':>12}")
+    for b, r in results.items():
+        print(f"{b:<14} {r['us_per_call']:>9.2f} {r['relative_time']:>9.3f} {r['peak_bytes_per_call']:>12.0f} {r['kept_bytes_per_call']:>12.1f}")
+
+    if save_baseline:
+        Path(baseline).write_text(json.dumps({"calls": calls, **results}, indent=2))
+        print(f"Saved baseline to '{baseline}'")
+
+    if check:
+        regressions = []
+        for b, r in results.items():
+            if b not in reference:
+                continue
+            ref = reference[b]
+            if r["relative_time"] > ref["relative_time"] * time_threshold:
+                regressions.append(f"{b}: {ref['relative_time']:.3f} -> {r['relative_time']:.3f} times the reference loop per call")
+            # a few bytes of noise are allowed for paths that barely allocate
+            if r["peak_bytes_per_call"] > ref["peak_bytes_per_call"] * memory_threshold + 64:
+                regressions.append(f"{b}: {ref['peak_bytes_per_call']:.0f} -> {r['peak_bytes_per_call']:.0f} peak bytes per call")
+            if r["kept_bytes_per_call"] > ref["kept_bytes_per_call"] * memory_threshold + 8:
+                regressions.append(f"{b}: {ref['kept_bytes_per_call']:.1f} -> {r['kept_bytes_per_call']:.1f} kept bytes per call")
+        if regressions:
+            print("\nRegressions compared to the baseline:")
+            for r in regressions:
+                print(f"  {r}")
+            sys.exit(1)
+        print("\nNo regression compared to the baseline.")
+
+
+if __name__ == "__main__":
+    Fire(bench)
@@ -0,0 +1,226 @@
+"""
+minimal reader of the sleep logs of SleepTk that only needs the standard
+library, for scripts that should start fast or run on small computers. The
+epochs of a log are read one line at a time as Epoch tuples. to_arrays
+returns all the columns at once, parsed in a single vectorized pass if
+numpy is installed.
+
+Usage: python log_reader.py T_F_V.csv [...]
+"""
+
+import io
+import sys
+from array import array
+from pathlib import Path
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+Epoch = namedtuple("Epoch", [
+        "timestamp",  # seconds since the start of the tracking
+        "unix_time",
+        "motion",  # float
+        "bpm",  # int, None if missing or invalid
+        "bpm_invalid",  # True if the watch failed to compute the BPM
+        "meta",  # int between 0 and 3, see night_loader.META_LABELS
+        ])
+
+
+def parse_filename(path):
+    "returns the start time T, saving interval F and version V of a log"
+    name = Path(path).name
+    assert name.count("_") >= 2, f"invalid filename '{name}'"
+    T, F, V = Path(path).stem.split("_")[:3]
+    return int(T), int(F), int(V)
+
+
+def _read_v1(lines, start, interval):
+    "epochs of a version 1 log, see night_loader for the format"
+    latest = -1  # like on the watch, the first elided timestamp is 0
+    for number, line in enumerate(lines, start=1):
+        if line is None:
+            # damaged row of a version 2 log
+            latest += 1
+            continue
+        line = line.strip()
+        if not line or line.startswith("Timestamp"):
+            continue
+        fields = line.split(",")
+        if len(fields) != 4:
+            raise ValueError(f"Line {number} has {len(fields)} fields instead of 4: '{line}'")
+        ts, motion, bpm, meta = fields
+        latest = int(float(ts)) if ts else latest + 1
+        invalid = bpm.strip() == "?"
+        yield Epoch(latest * interval,
+                    latest * interval + start,
+                    float(motion),
+                    int(float(bpm)) if bpm and not invalid else None,
+                    invalid,
+                    int(float(meta)) if meta else 0)
+
+
+def _read_v2(lines, start, interval):
+    """epochs of a version 2 log: like version 1 with a Check field ending
+    each row, rows not matching it are skipped"""
+    return _read_v1(_checked_rows(lines), start, interval)
+
+
+def _checked_rows(lines):
+    """rows of a version 2 log without their Check field, a damaged row is
+    replaced by an empty one that only advances the timestamp"""
+    for number, line in enumerate(lines, start=1):
+        line = line.rstrip("\n")
+        if number == 1:
+            yield "Timestamp"
+            continue
+        row, _, check = line.rpartition(",")
+        if len(check) == 3 and check.isdigit() and sum(row.encode("ascii", "replace")) % 256 == int(check):
+            yield row
+        else:
+            yield None
+
+
+# function reading the lines of a log for each version of the format
+READERS = {
+        1: _read_v1,
+        2: _read_v2,
+        }
+
+
+def read_epochs(path):
+    """generator of the Epoch of a log, reading one line at a time. Raises
+    ValueError for versions unknown to READERS"""
+    start, interval, version = parse_filename(path)
+    if version not in READERS:
+        raise ValueError(f"Unsupported log version {version} for '{path}'")
+    # damaged bytes of a version 2 log are decoded as they can and fail
+    # their check
+    with open(path, "r", errors="replace") as f:
+        yield from READERS[version](f, start, interval)
+
+
+def salvage(raw):
+    """
+    checks the Check field of every row of the bytes of a version 2 log at
+    once with numpy, returns the log without the Check fields as version 1
+    bytes and the number of damaged rows. Damaged rows are replaced by a
+    row with a Meta of -1 to be dropped after the timestamps are filled:
+    they count as an elided timestamp, which is right unless the damaged
+    row had a written one.
+    """
+    data = np.frombuffer(raw, dtype=np.uint8)
+    newlines = np.flatnonzero(data == ord("\n"))
+    starts = newlines + 1
+    ends = np.append(newlines[1:], len(data))
+
+    # the row is "...,ddd" with ddd the sum of the bytes before the comma
+    long_enough = ends - starts >= 4
+    comma = np.where(long_enough, ends - 4, 0)
+    digits = np.stack([data[np.where(long_enough, ends - k, 0)] for k in (3, 2, 1)]).astype(np.int64) - ord("0")
+    checked = np.sum(digits * np.array([[100], [10], [1]]), axis=0)
+    sums = np.concatenate([[0], np.cumsum(data, dtype=np.int64)])
+    valid = (long_enough
+             & (data[comma] == ord(","))
+             & np.all((digits >= 0) & (digits <= 9), axis=0)
+             & ((sums[comma] - sums[np.minimum(starts, comma)]) % 256 == checked))
+
+    rows = raw.split(b"\n")[1:]
+    content = [b"Timestamp,Motion,BPM,Meta"]
+    content.extend(row[:-4] if ok else b",,,-1" for row, ok in zip(rows, valid))
+    return b"\n".join(content), int((~valid).sum())
+
+
+def fill_timestamps(ts):
+    """number of intervals since the start of each row, from the Timestamp
+    column with NaN where it was elided: each elided value is the previous
+    one + 1, the value before the first row being -1 like on the watch"""
+    pos = np.arange(len(ts))
+    last_known = np.maximum.accumulate(np.where(np.isnan(ts), -1, pos))
+    base = np.where(last_known >= 0, ts[np.maximum(last_known, 0)], -1)
+    return (base + pos - last_known).astype(np.int64)
+
+
+def _to_arrays_numpy(path, start, interval, version):
+    """see to_arrays, the empty fields are written as nan so that all the
+    rows are parsed at once by the C parser of np.loadtxt"""
+    raw = Path(path).read_bytes()
+    if version == 2:
+        raw, _ = salvage(raw)
+    body = raw.replace(b"\r", b"").strip(b"\n")
+    header_end = body.find(b"\n")
+    body = b"" if header_end == -1 else body[header_end + 1:]
+    if not body:
+        table = np.zeros((0, 4))
+        invalid = np.zeros(0, dtype=bool)
+    else:
+        # only the BPM field can be "?"
+        data = np.frombuffer(body, dtype=np.uint8)
+        rows = np.concatenate([[0], np.cumsum(data == ord("\n"))])
+        invalid = np.zeros(rows[-1] + 1, dtype=bool)
+        invalid[rows[:-1][data == ord("?")]] = True
+        body = b"\n" + body.replace(b"?", b"") + b"\n"
+        for _ in range(2):  # twice for consecutive empty fields
+            body = body.replace(b",,", b",nan,")
+        body = body.replace(b"\n,", b"\nnan,").replace(b",\n", b",nan\n")
+        table = np.loadtxt(io.BytesIO(body), delimiter=",", ndmin=2)
+    if table.shape[1] != 4:
+        raise ValueError(f"'{path}' has {table.shape[1]} fields per row instead of 4")
+    ts, motion, bpm, meta = table.T
+    timestamp = fill_timestamps(ts) * interval
+    meta = np.nan_to_num(meta).astype(np.int8)
+    kept = meta != -1  # damaged rows of a version 2 log
+    out = {"timestamp": timestamp,
+           "unix_time": timestamp + start,
+           "motion": motion,
+           "bpm": bpm,
+           "bpm_invalid": invalid,
+           "meta": meta}
+    return {name: col[kept] for name, col in out.items()}
+
+
+def to_arrays(path):
+    """dict of the columns of a log: timestamp and unix_time as integers,
+    motion and bpm as floats (NaN if missing), bpm_invalid as booleans and
+    meta as integers. numpy arrays parsed in a single pass if numpy is
+    installed, array.array filled from read_epochs otherwise"""
+    if np is not None:
+        start, interval, version = parse_filename(path)
+        if version not in READERS:
+            raise ValueError(f"Unsupported log version {version} for '{path}'")
+        return _to_arrays_numpy(path, start, interval, version)
+    columns = {"timestamp": array("q"),
+               "unix_time": array("q"),
+               "motion": array("d"),
+               "bpm": array("d"),
+               "bpm_invalid": array("b"),
+               "meta": array("b")}
+    nan = float("nan")
+    for e in read_epochs(path):
+        columns["timestamp"].append(e.timestamp)
+        columns["unix_time"].append(e.unix_time)
+        columns["motion"].append(e.motion)
+        columns["bpm"].append(nan if e.bpm is None else e.bpm)
+        columns["bpm_invalid"].append(e.bpm_invalid)
+        columns["meta"].append(e.meta)
+    return columns
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        n = n_bpm = events = 0
+        bpm_sum = 0
+        last = None
+        for e in read_epochs(path):
+            n += 1
+            last = e
+            if e.bpm is not None:
+                n_bpm += 1
+                bpm_sum += e.bpm
+            if e.meta in (1, 3):
+                events += 1
+        duration = last.timestamp / 3600 if last else 0
+        mean = f"{bpm_sum / n_bpm:.1f}" if n_bpm else "-"
+        print(f"{Path(path).name}: {n} epochs, {duration:.2f}h, mean BPM {mean}, {events} wake events")
@@ -0,0 +1,211 @@
+"""
+consolidated archive of all the nights: every column of every night is
+stored contiguously in a flat binary file, opened with numpy.memmap so that
+longitudinal queries only read the slices they need instead of loading
+every csv file into memory.
+
+Layout of the archive directory:
+    index.bin: one ARCHIVE_INDEX_DTYPE record per night
+    <column>.bin: the values of the column for all the epochs of all the
+        nights, night after night, with the dtypes of ARCHIVE_COLUMNS
+
+New nights are appended at the end of the files. The index is written
+last, so epochs written by an interrupted append are ignored and
+overwritten by the next one.
+"""
+
+from pathlib import Path
+import numpy as np
+from fire import Fire
+
+from night_loader import load_night, parse_filename
+from pull_index import PullIndex, INDEX_NAME
+
+ARCHIVE_NAME = "archive"
+
+# nights of at most that many epochs are left out, like plotter.py which
+# trashes them, as the archive can not drop a night once it is added
+MIN_EPOCHS = 5
+
+# dtype of each column stored in the archive. Timestamp is the number of
+# seconds since the start of the night, BPM is NaN when missing
+ARCHIVE_COLUMNS = {
+        "Timestamp": np.int32,
+        "Motion": np.float32,
+        "BPM": np.float32,
+        "BPM_invalid": np.bool_,
+        "Meta": np.int8,
+        }
+
+ARCHIVE_INDEX_DTYPE = np.dtype([
+        ("start", np.int64),  # T: unix time of the start of the night
+        ("interval", np.int32),  # F: saving interval in seconds
+        ("version", np.int32),  # V: version of the log format
+        ("offset", np.int64),  # position of the first epoch in the columns
+        ("length", np.int64),  # number of epochs
+        ])
+
+
+class NightArchive:
+    """
+    memory mapped archive of nights, see the docstring of the module.
+
+    nights: structured array of the index, one row per night
+    column(name): memmap of a column over all nights
+    night(i): dict of the arrays of the i-th night
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        index_path = self.path / "index.bin"
+        size = index_path.stat().st_size if index_path.exists() else 0
+        # ignore a record that was partially written
+        n = size // ARCHIVE_INDEX_DTYPE.itemsize
+        if n:
+            self.nights = np.memmap(index_path, dtype=ARCHIVE_INDEX_DTYPE, mode="r", shape=(n,))
+        else:
+            self.nights = np.zeros(0, dtype=ARCHIVE_INDEX_DTYPE)
+        self.n_epochs = int(self.nights["offset"][-1] + self.nights["length"][-1]) if n else 0
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.nights)
+
+    def __contains__(self, start):
+        return bool((self.nights["start"] == start).any())
+
+    def column(self, name):
+        "memmap of a column over all the epochs of all the nights"
+        assert name in ARCHIVE_COLUMNS, f"Unknown column '{name}'"
+        if name not in self._columns:
+            if self.n_epochs:
+                self._columns[name] = np.memmap(self.path / f"{name}.bin",
+                                                dtype=ARCHIVE_COLUMNS[name],
+                                                mode="r",
+                                                shape=(self.n_epochs,))
+            else:
+                self._columns[name] = np.zeros(0, dtype=ARCHIVE_COLUMNS[name])
+        return self._columns[name]
+
+    def night(self, i, columns=None):
+        "dict of the columns of the i-th night, as views of the memmaps"
+        offset, length = int(self.nights["offset"][i]), int(self.nights["length"][i])
+        return {name: self.column(name)[offset:offset + length]
+                for name in (columns or ARCHIVE_COLUMNS)}
+
+    def select(self, since=None, until=None):
+        "indices of the nights starting between the unix times since and until"
+        mask = np.ones(len(self), dtype=bool)
+        if since is not None:
+            mask &= self.nights["start"] >= since
+        if until is not None:
+            mask &= self.nights["start"] < until
+        return np.flatnonzero(mask)
+
+    def night_of_epoch(self):
+        "array giving for each epoch the index of its night"
+        return np.repeat(np.arange(len(self)), self.nights["length"])
+
+    def unix_time(self, nights=None):
+        """unix time of each epoch, of all nights or only of the given
+        indices of nights, in the same order as their epochs"""
+        if nights is None:
+            nights = np.arange(len(self))
+        return np.concatenate(
+                [self.night(i, ["Timestamp"])["Timestamp"] + self.nights["start"][i] for i in nights]
+                ) if len(nights) else np.zeros(0, dtype=np.int64)
+
+    def append(self, df):
+        """add a night loaded by night_loader.load_night at the end of the
+        archive"""
+        start = df.attrs["start"]
+        assert start not in self, f"Night {start} is already in the archive"
+        # drop what an interrupted append may have left after the last night
+        for name, dtype in ARCHIVE_COLUMNS.items():
+            col_path = self.path / f"{name}.bin"
+            with open(col_path, "ab") as f:
+                f.truncate(self.n_epochs * np.dtype(dtype).itemsize)
+        self._columns = {}
+
+        values = {
+                "Timestamp": df["Timestamp"].to_numpy(),
+                "Motion": df["Motion"].to_numpy(),
+                "BPM": df["BPM"].to_numpy(),
+                "BPM_invalid": df["BPM_invalid"].to_numpy(),
+                "Meta": df["Meta"].cat.codes.to_numpy(),
+                }
+        for name, dtype in ARCHIVE_COLUMNS.items():
+            with open(self.path / f"{name}.bin", "ab") as f:
+                f.write(np.ascontiguousarray(values[name], dtype=dtype).tobytes())
+
+        record = np.array([(start,
+                            df.attrs["interval"],
+                            df.attrs["version"],
+                            self.n_epochs,
+                            len(df))],
+                          dtype=ARCHIVE_INDEX_DTYPE)
+        index_path = self.path / "index.bin"
+        with open(index_path, "ab") as f:
+            f.truncate(len(self) * ARCHIVE_INDEX_DTYPE.itemsize)
+            f.write(record.tobytes())
+        self._load_index()
+
+    def add_file(self, path):
+        """parse a log and append it, returns False if it was already in
+        the archive or has at most MIN_EPOCHS epochs"""
+        start, _, _ = parse_filename(path)
+        if start in self:
+            return False
+        df = load_night(path)
+        if len(df) <= MIN_EPOCHS:
+            return False
+        self.append(df)
+        return True
+
+    def update(self, local_dir):
+        """append the nights of local_dir missing from the archive, in
+        chronological order, returns how many were added. The files that
+        the pull index records as not verified yet are skipped, the ones it
+        does not know about (pulled before it existed or copied by hand)
+        are added"""
+        local_dir = Path(local_dir)
+        unverified = set()
+        if (local_dir / INDEX_NAME).exists():
+            index = PullIndex(local_dir)
+            unverified = {night["name"] for night in index.catalog(verified_only=False)
+                          if not night["verified"]}
+            index.close()
+        files = [f for f in local_dir.glob("*.csv") if f.name not in unverified]
+        added = 0
+        for f in sorted(files, key=lambda f: parse_filename(f)[0]):
+            if f.exists() and self.add_file(f):
+                added += 1
+        return added
+
+
+def update_archive(local_dir="remote_files/logs/sleep", archive_dir=None):
+    """
+    append to the archive the nights of local_dir that are not in it yet.
+    The nights that the pull index of local_dir records as not verified
+    yet are skipped, every other csv file is added.
+
+    Parameters
+    ----------
+    local_dir: str, default "remote_files/logs/sleep"
+        directory containing the logs
+    archive_dir: str, default None
+        location of the archive, None to use an 'archive' subdirectory of
+        local_dir
+    """
+    local_dir = Path(local_dir)
+    assert local_dir.exists(), f"Directory '{local_dir}' does not exist"
+    archive = NightArchive(archive_dir or local_dir / ARCHIVE_NAME)
+    added = archive.update(local_dir)
+    print(f"Added {added} nights to the archive, which now contains {len(archive)} nights and {archive.n_epochs} epochs.")
+
+
+if __name__ == "__main__":
+    Fire(update_archive)
@@ -0,0 +1,178 @@
+"""
+loader of the sleep logs written by SleepTk, usable on its own or by
+plotter.py
+
+The logs are stored as T_F_V.csv where T is the unix time of the start of
+the tracking session, F the saving interval in seconds and V the version
+of the format. Each row contains:
+    Timestamp: number of intervals elapsed since the start, only written
+        when it is not the previous value + 1 (i.e. when saving was delayed)
+    Motion: motion angle computed by the watch
+    BPM: heart rate, "?" if the watch failed to compute it, empty if none
+    Meta: 0 or empty if nothing happened, 1 if the watch was touched or
+        pressed, 2 if a gradual or natural wake vibration happened, 3 if both
+
+Since version 2, each row ends with a Check field: the sum of the bytes of
+the row before the last comma, modulo 256, written with 3 digits. A row
+left incomplete by a reset of the watch during a save, or otherwise
+damaged, does not match its Check and is dropped by the loader.
+"""
+
+import io
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from log_reader import parse_filename, salvage, fill_timestamps
+
+# meaning of the values of the Meta column
+META_LABELS = {
+        0: "nothing",
+        1: "touched",
+        2: "vibration",
+        3: "both",
+        }
+
+SUPPORTED_VERSIONS = [1, 2]
+
+# to increase whenever the output of load_night changes, this invalidates
+# the cached nights
+LOADER_VERSION = 2
+
+# suffix added to the name of a log to get the name of its cache
+CACHE_SUFFIX = ".cache.npz"
+
+# columns stored in the cache, the others are cheap to recompute
+_CACHED_COLUMNS = ["Timestamp", "Motion", "BPM", "BPM_invalid", "Meta", "clock"]
+
+
+def load_night(path, cache=False):
+    """
+    load a sleep log as a typed DataFrame with the columns:
+        Timestamp: int, seconds elapsed since the start of the recording
+        Motion: float, as stored by the watch
+        BPM: float, NaN if missing or invalid
+        BPM_invalid: bool, True if the watch failed to compute the BPM
+        Meta: categorical of the keys of META_LABELS
+        UNIX_time: int
+        date: datetime64, in UTC
+        clock: str, time of the day as HH:MM:SS
+    The start time, interval, version and path are stored in df.attrs, as
+    well as the number of damaged rows that were dropped as "corrupt".
+
+    If cache is True, the parsed night is stored next to the log as
+    T_F_V.csv.cache.npz and reused as long as the log keeps the same
+    modification time and size and LOADER_VERSION is unchanged.
+    """
+    path = Path(path)
+    start, interval, version = parse_filename(path)
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError(f"Unsupported log version {version} for '{path}'")
+
+    if cache:
+        df = _read_cache(path)
+        if df is None:
+            df = _parse(path, start, interval, version)
+            _write_cache(path, df)
+        return df
+    return _parse(path, start, interval, version)
+
+
+def _salvage(path):
+    """content of a version 2 log without its Check fields as a file object
+    and the number of damaged rows, see log_reader.salvage"""
+    content, corrupt = salvage(Path(path).read_bytes())
+    return io.BytesIO(content), corrupt
+
+
+def _parse(path, start, interval, version):
+    "parse a log from its csv file"
+    source, corrupt = (path, 0) if version == 1 else _salvage(path)
+    df = pd.read_csv(source, dtype={"Timestamp": "float64",
+                                  "Motion": "float64",
+                                  "BPM": "string",
+                                  "Meta": "float64"})
+    # fill the elided timestamps: each one is the previous value + 1, the
+    # value before the first row being -1 like on the watch
+    df["Timestamp"] = fill_timestamps(df["Timestamp"].to_numpy()) * interval
+    df = df[df["Meta"] != -1].reset_index(drop=True)
+    df.attrs.update({"start": start,
+                     "interval": interval,
+                     "version": version,
+                     "path": str(path),
+                     "corrupt": corrupt})
+
+    df["Motion"] = df["Motion"].astype("float64")
+
+    bpm = df["BPM"].str.strip()
+    df["BPM_invalid"] = (bpm == "?").fillna(False).astype(bool)
+    df["BPM"] = pd.to_numeric(bpm.where(~df["BPM_invalid"]), errors="coerce").astype("float64")
+
+    meta = df["Meta"].fillna(0).astype(int)
+    if not meta.isin(list(META_LABELS.keys())).all():
+        raise ValueError(f"Unknown Meta values in '{path}': {sorted(set(meta) - set(META_LABELS))}")
+    df["Meta"] = pd.Categorical(meta, categories=list(META_LABELS.keys()))
+
+    _add_time_columns(df)
+    df["clock"] = df["date"].dt.strftime("%H:%M:%S")
+    return df
+
+
+def _add_time_columns(df):
+    "add the columns UNIX_time and date, derived from Timestamp"
+    df["UNIX_time"] = df["Timestamp"] + df.attrs["start"]
+    df["date"] = pd.to_datetime(df["UNIX_time"], unit="s")
+
+
+def _cache_key(path):
+    "what the cache of a log has to match to be valid"
+    stat = path.stat()
+    return np.array([LOADER_VERSION, stat.st_mtime_ns, stat.st_size], dtype="int64")
+
+
+def _read_cache(path):
+    "returns the cached DataFrame of a log or None if missing or outdated"
+    cache_path = path.parent / (path.name + CACHE_SUFFIX)
+    if not cache_path.exists():
+        return None
+    try:
+        with np.load(cache_path, allow_pickle=False) as data:
+            if not np.array_equal(data["key"], _cache_key(path)):
+                return None
+            df = pd.DataFrame({col: data[col] for col in _CACHED_COLUMNS})
+            corrupt = int(data["corrupt"])
+    except Exception:
+        # unreadable cache, for example if a write was interrupted
+        return None
+    start, interval, version = parse_filename(path)
+    df.attrs.update({"start": start,
+                     "interval": interval,
+                     "version": version,
+                     "path": str(path),
+                     "corrupt": corrupt})
+    df["Meta"] = pd.Categorical.from_codes(df["Meta"], categories=list(META_LABELS.keys()))
+    df["clock"] = df["clock"].astype(str)
+    _add_time_columns(df)
+    return df[["Timestamp", "Motion", "BPM", "Meta", "BPM_invalid", "UNIX_time", "date", "clock"]]
+
+
+def _write_cache(path, df):
+    "store the parsed log next to it, silently giving up on failure"
+    cache_path = path.parent / (path.name + CACHE_SUFFIX)
+    tmp_path = cache_path.parent / (cache_path.name + ".tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f,
+                     key=_cache_key(path),
+                     corrupt=df.attrs["corrupt"],
+                     Timestamp=df["Timestamp"].to_numpy(),
+                     Motion=df["Motion"].to_numpy(),
+                     BPM=df["BPM"].to_numpy(),
+                     BPM_invalid=df["BPM_invalid"].to_numpy(),
+                     Meta=df["Meta"].cat.codes.to_numpy(),
+                     clock=df["clock"].to_numpy(dtype="U8"))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if tmp_path.exists():
+            tmp_path.unlink()
@@ -0,0 +1,293 @@
+"""
+static HTML report of all the nights, to browse them in any web browser
+without python. The motion, heart rate and meta events of every night are
+embedded at several resolutions (downsampled with plotter.lttb) and the page
+only draws the resolution that matches the zoom level, so zooming stays
+smooth over months of data.
+
+The downsampled series of each night are kept in report_data.json next to
+the report, so that only new or modified nights are processed when the
+report is updated.
+"""
+
+import json
+from pathlib import Path
+from datetime import datetime
+from fire import Fire
+
+from night_loader import load_night, parse_filename
+from plotter import lttb, clean_motion
+
+REPORT_NAME = "report.html"
+DATA_NAME = "report_data.json"
+
+# number of points of each resolution of a night, the full resolution is
+# added if the night is longer
+LEVELS = [32, 128, 512]
+
+# to increase whenever the content of report_data.json changes
+REPORT_VERSION = 1
+
+
+def night_series(path):
+    """dict of the downsampled series of a night, the times being in
+    seconds since its start, or None if the night has too few rows"""
+    df = load_night(path, cache=True)
+    if len(df) <= 5:
+        return None
+    clean_motion(df)
+    t = df["Timestamp"].to_numpy().astype(float)
+    motion = df["Motion"].to_numpy()
+    peak = motion.max()
+    if peak > 0:
+        motion = motion / peak  # each night is drawn using its whole height
+    bpm_mask = df["BPM"].notna().to_numpy()
+    bpm_t, bpm = t[bpm_mask], df["BPM"].to_numpy()[bpm_mask]
+    meta = df["Meta"].cat.codes.to_numpy()
+
+    def levels(x, y):
+        out = []
+        for n in LEVELS + [len(x)]:
+            if n <= len(x) and (not out or n > len(out[-1][0])):
+                lx, ly = lttb(x, y, n)
+                out.append([[int(v) for v in lx], [round(float(v), 3) for v in ly]])
+        return out
+
+    return {
+            "name": Path(path).name,
+            "start": df.attrs["start"],
+            "duration": int(t[-1]) if len(t) else 0,
+            "motion": levels(t, motion),
+            "bpm": levels(bpm_t, bpm),
+            "meta": [[int(a), int(b)] for a, b in zip(t[meta > 0], meta[meta > 0])],
+            "bpm_mean": round(float(bpm.mean()), 1) if len(bpm) else None,
+            "bpm_min": int(bpm.min()) if len(bpm) else None,
+            "bpm_max": int(bpm.max()) if len(bpm) else None,
+            }
+
+
+def build_report(local_dir="remote_files/logs/sleep", out_dir=None):
+    """
+    create or update the HTML report of the nights of local_dir
+
+    Parameters
+    ----------
+    local_dir: str, default "remote_files/logs/sleep"
+        directory containing the logs
+    out_dir: str, default None
+        where to write report.html and report_data.json, None for local_dir
+    """
+    local_dir = Path(local_dir)
+    assert local_dir.exists(), f"Directory '{local_dir}' does not exist"
+    out_dir = Path(out_dir) if out_dir is not None else local_dir
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    data_path = out_dir / DATA_NAME
+    cached = {}
+    if data_path.exists():
+        content = json.loads(data_path.read_text())
+        if content.get("version") == REPORT_VERSION:
+            cached = content["nights"]
+
+    nights = {}
+    updated = 0
+    for f in sorted(local_dir.glob("*.csv"), key=lambda f: parse_filename(f)[0]):
+        stat = f.stat()
+        key = [stat.st_mtime_ns, stat.st_size]
+        if f.name in cached and cached[f.name]["key"] == key:
+            nights[f.name] = cached[f.name]
+            continue
+        nights[f.name] = {"key": key, "series": night_series(f)}
+        updated += 1
+
+    data_path.write_text(json.dumps({"version": REPORT_VERSION, "nights": nights}))
+    series = [n["series"] for n in nights.values() if n["series"] is not None]
+    html = _TEMPLATE.replace("__DATA__", json.dumps(series, separators=(",", ":")))
+    html = html.replace("__GENERATED__", datetime.now().isoformat(timespec="seconds"))
+    (out_dir / REPORT_NAME).write_text(html)
+    print(f"Updated {updated} nights, the report of {len(series)} nights is at '{out_dir / REPORT_NAME}'")
+
+
+_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>SleepTk nights</title>
+<style>
+body { font-family: sans-serif; margin: 1em; background: #fafafa; }
+canvas { width: 100%; height: 420px; background: white; border: 1px solid #ccc; cursor: grab; }
+table { border-collapse: collapse; margin-top: 1em; }
+td, th { padding: 2px 10px; text-align: right; }
+tr.night:hover { background: #eee; cursor: pointer; }
+.legend span { margin-right: 1.5em; }
+</style>
+</head>
+<body>
+<h2>SleepTk nights</h2>
+<div>
+<button onclick="showLast(1)">Last night</button>
+<button onclick="showLast(7)">Last week</button>
+<button onclick="showLast(30)">Last month</button>
+<button onclick="showLast(NIGHTS.length)">All</button>
+<span class="legend">
+<span style="color:purple">&#9644; Motion</span>
+<span style="color:red">&#9644; BPM</span>
+<span style="color:green">&#9474; Touched</span>
+<span style="color:blue">&#9474; Vibration</span>
+<span style="color:black">&#9474; Both</span>
+</span>
+<small>Scroll to zoom, drag to move. Times are in UTC. Generated __GENERATED__.</small>
+</div>
+<canvas id="plot"></canvas>
+<table id="nights"><tr><th>Night</th><th>Duration</th><th>BPM mean</th><th>BPM range</th><th>Events</th></tr></table>
+<script>
+const NIGHTS = __DATA__;
+const META_COLORS = {1: "green", 2: "blue", 3: "black"};
+const BPM_RANGE = [40, 100];
+const canvas = document.getElementById("plot");
+const ctx = canvas.getContext("2d");
+let view = [0, 1];
+
+function resize() {
+  canvas.width = canvas.clientWidth * devicePixelRatio;
+  canvas.height = canvas.clientHeight * devicePixelRatio;
+  draw();
+}
+
+function pickLevel(levels, pixels) {
+  // coarsest resolution with about one point per pixel
+  for (const level of levels) {
+    if (level[0].length >= pixels) return level;
+  }
+  return levels[levels.length - 1];
+}
+
+function niceStep(span) {
+  const steps = [600, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 86400, 7 * 86400, 30 * 86400];
+  for (const s of steps) {
+    if (span / s <= 10) return s;
+  }
+  return 90 * 86400;
+}
+
+function draw() {
+  const W = canvas.width, H = canvas.height, pad = 30 * devicePixelRatio;
+  const plotH = H - 2 * pad;
+  const span = view[1] - view[0];
+  const x = t => (t - view[0]) / span * W;
+  ctx.clearRect(0, 0, W, H);
+  ctx.font = (11 * devicePixelRatio) + "px sans-serif";
+
+  // time axis
+  const step = niceStep(span);
+  ctx.fillStyle = "#666";
+  ctx.strokeStyle = "#eee";
+  for (let t = Math.ceil(view[0] / step) * step; t < view[1]; t += step) {
+    ctx.beginPath(); ctx.moveTo(x(t), pad); ctx.lineTo(x(t), H - pad); ctx.stroke();
+    const d = new Date(t * 1000).toISOString();
+    const label = step >= 86400 ? d.slice(0, 10) : (step >= 3600 ? d.slice(5, 10) + " " + d.slice(11, 16) : d.slice(11, 16));
+    ctx.fillText(label, x(t) + 2, H - pad / 3);
+  }
+
+  for (const n of NIGHTS) {
+    const end = n.start + n.duration;
+    if (end < view[0] || n.start > view[1]) continue;
+    const pixels = (end - n.start) / span * W;
+
+    // meta events
+    for (const [t, code] of n.meta) {
+      ctx.strokeStyle = META_COLORS[code];
+      ctx.setLineDash([2, 3]);
+      ctx.beginPath(); ctx.moveTo(x(n.start + t), pad); ctx.lineTo(x(n.start + t), H - pad); ctx.stroke();
+    }
+    ctx.setLineDash([]);
+
+    // motion, each night scaled to the height of the plot
+    if (n.motion.length) {
+      const [ts, ys] = pickLevel(n.motion, pixels);
+      ctx.strokeStyle = "purple";
+      ctx.beginPath();
+      ts.forEach((t, i) => {
+        const px = x(n.start + t), py = H - pad - ys[i] * plotH;
+        i ? ctx.lineTo(px, py) : ctx.moveTo(px, py);
+      });
+      ctx.stroke();
+    }
+
+    // heart rate
+    if (n.bpm.length) {
+      const [ts, ys] = pickLevel(n.bpm, pixels);
+      ctx.strokeStyle = "red";
+      ctx.beginPath();
+      ts.forEach((t, i) => {
+        const v = (ys[i] - BPM_RANGE[0]) / (BPM_RANGE[1] - BPM_RANGE[0]);
+        const px = x(n.start + t), py = H - pad - Math.min(Math.max(v, 0), 1) * plotH;
+        i ? ctx.lineTo(px, py) : ctx.moveTo(px, py);
+      });
+      ctx.stroke();
+    }
+  }
+  ctx.fillStyle = "red";
+  ctx.fillText(BPM_RANGE[1] + " BPM", W - 60 * devicePixelRatio, pad - 4);
+  ctx.fillText(BPM_RANGE[0] + " BPM", W - 60 * devicePixelRatio, H - pad - 4);
+}
+
+function showRange(start, end) {
+  const margin = (end - start) * 0.02;
+  view = [start - margin, end + margin];
+  draw();
+}
+
+function showLast(n) {
+  if (!NIGHTS.length) return;
+  const nights = NIGHTS.slice(-n);
+  const last = nights[nights.length - 1];
+  showRange(nights[0].start, last.start + last.duration);
+}
+
+canvas.addEventListener("wheel", e => {
+  e.preventDefault();
+  const rect = canvas.getBoundingClientRect();
+  const t = view[0] + (e.clientX - rect.left) / rect.width * (view[1] - view[0]);
+  const factor = e.deltaY > 0 ? 1.25 : 0.8;
+  view = [t - (t - view[0]) * factor, t + (view[1] - t) * factor];
+  draw();
+}, {passive: false});
+
+let dragging = null;
+canvas.addEventListener("mousedown", e => { dragging = [e.clientX, view.slice()]; });
+window.addEventListener("mouseup", () => { dragging = null; });
+window.addEventListener("mousemove", e => {
+  if (!dragging) return;
+  const dt = (e.clientX - dragging[0]) / canvas.clientWidth * (dragging[1][1] - dragging[1][0]);
+  view = [dragging[1][0] - dt, dragging[1][1] - dt];
+  draw();
+});
+window.addEventListener("resize", resize);
+
+const table = document.getElementById("nights");
+for (const n of NIGHTS.slice().reverse()) {
+  const row = table.insertRow();
+  row.className = "night";
+  const h = Math.floor(n.duration / 3600), m = Math.floor(n.duration % 3600 / 60);
+  const cells = [
+    new Date(n.start * 1000).toISOString().slice(0, 16).replace("T", " "),
+    h + "h" + String(m).padStart(2, "0"),
+    n.bpm_mean === null ? "-" : n.bpm_mean,
+    n.bpm_min === null ? "-" : n.bpm_min + "-" + n.bpm_max,
+    n.meta.length,
+  ];
+  for (const c of cells) row.insertCell().textContent = c;
+  row.onclick = () => showRange(n.start, n.start + n.duration);
+}
+
+showLast(7);
+resize();
+</script>
+</body>
+</html>
+"""
+
+
+if __name__ == "__main__":
+    Fire(build_report)
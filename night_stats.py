@@ -0,0 +1,167 @@
+"""
+longitudinal statistics of the nights: a few aggregates are computed once
+per night and kept in a small SQLite table next to the logs, then rolled up
+by week or by month. A night is only processed again if its log changed,
+so updating the statistics every day only costs the new night.
+"""
+
+import sqlite3
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from fire import Fire
+
+from night_loader import load_night, parse_filename, LOADER_VERSION
+from sleep_staging import stage_night
+
+STATS_DB_NAME = "night_stats.sqlite"
+
+# to increase whenever the aggregates change, this recomputes all of them
+STATS_VERSION = 2
+
+# aggregates of a night, in the order of the columns of the table
+AGGREGATES = [
+        "start",  # unix time of the start of the tracking
+        "duration_h",  # hours between the start and the last row
+        "sleep_h",  # hours of epochs not staged as wake by sleep_staging
+        "epochs",  # number of rows
+        "wake_events",  # rows where the watch was touched (meta 1 or 3)
+        "vibrations",  # rows with a gradual or natural wake vibration (meta 2 or 3)
+        "bpm_mean",
+        "bpm_min",
+        "bpm_max",
+        "bpm_invalid",  # number of failed heart rate measurements
+        "motion_mean",  # mean absolute change of motion between two rows
+        ]
+
+
+def night_aggregates(path):
+    "dict of the AGGREGATES of a log"
+    df = load_night(path, cache=True)
+    start, interval, version = parse_filename(path)
+    meta = df["Meta"].cat.codes.to_numpy()
+    bpm = df["BPM"].dropna()
+    stages = stage_night(df)
+    return {
+            "start": start,
+            "duration_h": (int(df["Timestamp"].iloc[-1]) if len(df) else 0) / 3600,
+            "sleep_h": float((stages != 0).sum()) * interval / 3600,
+            "epochs": len(df),
+            "wake_events": int(np.isin(meta, [1, 3]).sum()),
+            "vibrations": int(np.isin(meta, [2, 3]).sum()),
+            "bpm_mean": float(bpm.mean()) if len(bpm) else None,
+            "bpm_min": float(bpm.min()) if len(bpm) else None,
+            "bpm_max": float(bpm.max()) if len(bpm) else None,
+            "bpm_invalid": int(df["BPM_invalid"].sum()),
+            "motion_mean": float(df["Motion"].diff().abs().mean()) if len(df) > 1 else None,
+            }
+
+
+class NightStats:
+    """
+    table of the aggregates of each night, with the modification time and
+    size of the log they were computed from
+    """
+    def __init__(self, local_dir):
+        self.local_dir = Path(local_dir)
+        self.db = sqlite3.connect(str(self.local_dir / STATS_DB_NAME))
+        columns = ", ".join(f"{a} REAL" for a in AGGREGATES)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS nights ("
+            "name TEXT PRIMARY KEY, "
+            "mtime_ns INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "version INTEGER NOT NULL, "
+            f"{columns})")
+        self.db.commit()
+
+    def update(self):
+        """compute the aggregates of the new or modified logs and forget the
+        deleted ones, returns the number of nights computed"""
+        version = STATS_VERSION * 1000 + LOADER_VERSION
+        known = {name: (mtime_ns, size, v) for name, mtime_ns, size, v in
+                 self.db.execute("SELECT name, mtime_ns, size, version FROM nights")}
+        files = {f.name: f for f in self.local_dir.glob("*.csv")}
+        computed = 0
+        for name, f in sorted(files.items()):
+            stat = f.stat()
+            if known.get(name) == (stat.st_mtime_ns, stat.st_size, version):
+                continue
+            self.add(f, night_aggregates(f), commit=False)
+            computed += 1
+        for name in set(known) - set(files):
+            self.db.execute("DELETE FROM nights WHERE name = ?", (name,))
+        self.db.commit()
+        return computed
+
+    def add(self, path, aggregates, commit=True):
+        """store the aggregates of a log computed by night_aggregates, for
+        example in another process"""
+        path = Path(path)
+        stat = path.stat()
+        self.db.execute(
+            f"INSERT OR REPLACE INTO nights (name, mtime_ns, size, version, {', '.join(AGGREGATES)}) "
+            f"VALUES (?, ?, ?, ?, {', '.join('?' * len(AGGREGATES))})",
+            (path.name, stat.st_mtime_ns, stat.st_size, STATS_VERSION * 1000 + LOADER_VERSION,
+             *[aggregates[a] for a in AGGREGATES]))
+        if commit:
+            self.db.commit()
+
+    def nights(self):
+        "DataFrame of the aggregates of every night, indexed by start date"
+        df = pd.read_sql_query(f"SELECT name, {', '.join(AGGREGATES)} FROM nights", self.db)
+        df["date"] = pd.to_datetime(df["start"], unit="s")
+        return df.set_index("date").sort_index()
+
+    def close(self):
+        self.db.close()
+
+
+def rollup(nights, period="W"):
+    """weekly ("W") or monthly ("M") views of the aggregates of nights as
+    returned by NightStats.nights: number of nights, sums of the events and
+    means of the rest"""
+    assert period in ["W", "M"], f"Unknown period '{period}'"
+    nights = nights[nights["epochs"] > 5]
+    grouped = nights.resample("W-MON" if period == "W" else "MS", label="left", closed="left")
+    out = grouped[["duration_h", "sleep_h", "bpm_mean", "motion_mean"]].mean()
+    out["bpm_min"] = grouped["bpm_min"].min()
+    out["bpm_max"] = grouped["bpm_max"].max()
+    out["wake_events"] = grouped["wake_events"].sum()
+    out["vibrations"] = grouped["vibrations"].sum()
+    out.insert(0, "nights", grouped["epochs"].count())
+    return out[out["nights"] > 0]
+
+
+def stats(local_dir="remote_files/logs/sleep", period="week", last=None):
+    """
+    update the aggregates of the nights of local_dir and print them
+
+    Parameters
+    ----------
+    local_dir: str, default "remote_files/logs/sleep"
+        directory containing the logs
+    period: str, default "week"
+        "night", "week" or "month"
+    last: int, default None
+        only print the last rows
+    """
+    assert period in ["night", "week", "month"], f"Unknown period '{period}'"
+    assert Path(local_dir).exists(), f"Directory '{local_dir}' does not exist"
+    table = NightStats(local_dir)
+    computed = table.update()
+    nights = table.nights()
+    table.close()
+    print(f"Computed the statistics of {computed} new or modified nights, {len(nights)} nights in total.\n")
+    if period == "night":
+        out = nights.drop(columns=["start"])
+    else:
+        out = rollup(nights, "W" if period == "week" else "M")
+    if last is not None:
+        out = out.tail(last)
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(out.round(2).to_string())
+
+
+if __name__ == "__main__":
+    Fire(stats)
@@ -1,12 +1,22 @@
 from pathlib import Path
 from fire import Fire
-import pandas as pd
 from tqdm import tqdm
 import numpy as np
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
 from send2trash import send2trash
 
+from night_loader import load_night, CACHE_SUFFIX
+
+# color and legend of the vertical lines of each value of Meta
+_META_STYLE = {
+        1: ("green", "Touched"),
+        2: ("blue", "Small vibration"),
+        3: ("black", "Both"),
+        }
+
 
 # SETTINGS ###################################################################
 ##############################################################################
@@ -15,6 +25,10 @@ def plot(show_or_saveimg="both",
          local_dir="./remote_files/logs/sleep/",
          open_console=False,
          n_last=3,
+         cache=True,
+         workers=1,
+         dpi=150,
+         max_points=None,
          ):
     """
     simple script to import the sleep data into pandas and create plots
@@ -33,12 +47,27 @@ def plot(show_or_saveimg="both",
         all files but the recordings of the last 3 nights'. This is useful if
         you have lots of recordings and want to see only the last few nights.
         None to disable.
+    cache: bool, default True
+        if True, the parsed nights are cached next to the csv files to
+        load them faster the next times, see night_loader.load_night
+    workers: int, default 1
+        number of processes used to load and render the recordings. Values
+        above 1 are meant for exporting many nights at once and require
+        show_or_saveimg to be "saveimg".
+    dpi: int, default 150
+        resolution of the saved plots
+    max_points: int, default None
+        each curve is downsampled to that many points before being drawn,
+        using the largest triangle three buckets algorithm. None to use the
+        width of the figure in pixels.
     """
     if isinstance(local_dir, str):
         local_dir = Path(local_dir)
     # check arguments
     assert local_dir.exists(), "Remote directory does not exist"
     assert show_or_saveimg in ["show", "saveimg", "both"], "Wrong 'show_or_saveimg' value"
+    assert isinstance(workers, int) and workers >= 1, "Wrong 'workers' value"
+    assert workers == 1 or show_or_saveimg == "saveimg", "Using several workers requires show_or_saveimg='saveimg'"
 
     # load files
     files = sorted([f for f in local_dir.iterdir() if str(f).endswith(".csv")])
@@ -50,164 +79,27 @@ def plot(show_or_saveimg="both",
     print(f"{len(files)} files found.\r")
 
     recordings = {}  # where the df will be stored
-    for file in tqdm(files, desc="Loading files"):
-        # load file
-        df = pd.read_csv(file)
-
-        # ignore small files
-        if len(df.index.tolist()) == 0:
-            tqdm.write(f"  No data in df '{file}'. Ignoring this file.")
-            continue
-        elif len(df.index.tolist()) <= 5:
-            tqdm.write(f"  Not enough data ({len(df.index.tolist())} elems) in df '{file}'. Trashing this file.")
-            try:
-                send2trash(file)
-            except Exception as err:
-                tqdm.write(f"Exception when trashing '{file}': '{err}'")
-            continue
-
-        # detect version number and saving interval
-        assert file.name.count("_") >= 2, "invalid filename"
-        version = int(file.name.split("_")[2].replace(".csv", ""))
-        interval = int(file.name.split("_")[1])
-
-        # fill elipsed timestamp value
-        df.iloc[0]["Timestamp"] = 1
-        for i, row in df.iterrows():
-            if i == 0:
-                continue
-            if pd.isna(df.loc[i, "Timestamp"]):
-                assert not pd.isna(df.loc[i - 1, "Timestamp"]), "ERROR"
-                df.loc[i, "Timestamp"] = (df.loc[i - 1, "Timestamp"] + 1)
-        df["Timestamp"] *= interval
-        df["Timestamp"] = df["Timestamp"].astype(int)
-
-        # time data correction and loading
-        offset = int(str(file).split("/")[-1].split("_")[0])
-        df["UNIX_time"] = df["Timestamp"] + int(offset)
-        df["date"] = [datetime.utcfromtimestamp(unix)
-                      for unix in df["UNIX_time"].tolist()]
-        df["clock"] = pd.to_datetime(df["date"]).dt.time
-        df["clock"] = df["clock"].astype(str)
-        recording_date = str(datetime.utcfromtimestamp(offset))
-
-        # cast types and fill ellipsed values
-        df.loc[df["Meta"].isna(), "Meta"] = 0
-        df.loc[df["BPM"].isna(), "BPM"] = "?"
-        df["Meta"] = df["Meta"].astype(int)
-
-        # process motion signal
-        df["Motion"] /= 1000
-        df["Motion"] = df["Motion"].diff().abs()
-
-        # replace first value that got erased by abs()
-        df["Motion"].fillna(0.0, inplace=True)
-
-        # clip values that are too high
-        df["Motion"].clip(lower=0, upper=df["Motion"].quantile(0.95), inplace=True)
-
-        # compute smoothing etc if desired
-        #df["Motion"] = df["Motion"].rolling(window=4, center=True, closed='both').max()
-
-        # store df
-        recordings[recording_date] = df
-
-        # plot data and save to file
-        try:
-            # init plot
-            fig, ax = plt.subplots()
-            ax.set_xlabel("Time")
-            ax.set_title(f"{recording_date}  ({file.name})")
-
-            # plot bpm data if present
-            bpm_vals = df.loc[ df["BPM"].dropna() != "?"].index.tolist()
-            if len(bpm_vals) >= 2:
-                df.loc[bpm_vals, "BPM"] = df.loc[bpm_vals, "BPM"].astype(int)
-                #df.loc[bpm_vals, "BPM"] = df.loc[bpm_vals, "BPM"].rolling(window=10, center=True, closed='both').mean().rolling(window=3, center=True, closed='both').mean()
-                ax_bpm = ax.twinx()
-                ax_bpm.set_ylabel("BPM")
-                max_bpm = int(df.loc[bpm_vals, "BPM"].dropna().values.max())
-                min_bpm = int(df.loc[bpm_vals, "BPM"].dropna().values.min())
-                print(f"BPM range: {min_bpm}-{max_bpm}")
-                ax_bpm.plot(df.loc[bpm_vals, "Timestamp"],
-                            df.loc[bpm_vals, "BPM"],
-                            color="red",
-                            linewidth=0.5,
-                            label="BPM")
-
-            # plot motion
-            ax.plot(df["Timestamp"],
-                    df["Motion"],
-                    color="purple",
-                    linewidth=1,
-                    label="Motion")
-
-            # add hour time as xlabels only every 4 recording
-            ax.set_xticks(ticks=df["Timestamp"])
-            partial_clock = df["clock"].tolist()
-            for i, pc in enumerate(partial_clock):
-                if i % 4 != 0:
-                    partial_clock[i] = ""
-            ax.set_xticklabels(partial_clock, rotation=90)
-
-            # add vertical lines depending on state
-            ymin = df["Motion"].min()
-            ymax = df["Motion"].max()
-            assert ymin != ymax  # if equal, they are probably both np.nan
-
-            touched_ind = []
-            gradual_vib = []
-            both = []
-            for ind in df.index:
-                if df.loc[ind, "Meta"] == 0:
-                    continue
-                if df.loc[ind, "Meta"] == 1:
-                    touched_ind.append(ind)
-                elif df.loc[ind, "Meta"] == 2:
-                    gradual_vib.append(ind)
-                elif df.loc[ind, "Meta"] == 3:
-                    both.append(ind)
-                else:
-                    raise ValueError()
-            if len(touched_ind) > 0:
-                ax.vlines(x=df.loc[touched_ind, "Timestamp"],
-                          ymin=ymin,
-                          ymax=ymax,
-                          color="green",
-                          linestyle="dotted",
-                          linewidth=2.5,
-                          label="Touched")
-            if len(gradual_vib) > 0:
-                ax.vlines(x=df.loc[gradual_vib, "Timestamp"],
-                          ymin=ymin,
-                          ymax=ymax,
-                          color="blue",
-                          linestyle="dotted",
-                          linewidth=2.5,
-                          label="Small vibration")
-            if len(both) > 0:
-                ax.vlines(x=df.loc[both, "Timestamp"],
-                          ymin=ymin,
-                          ymax=ymax,
-                          color="black",
-                          linestyle="dotted",
-                          linewidth=2.5,
-                          label="Both")
-            # save or show
-            fig.legend(fontsize=10,
-                       prop={"size": 10},
-                       )
-            if show_or_saveimg in ["saveimg", "both"]:
-                fig.savefig(f"{local_dir}/{offset}.png",
-                            bbox_inches="tight",
-                            dpi=150)
-                tqdm.write(f"Saved plot of '{file}' as png.")
-            if show_or_saveimg in ["show", "both"]:
-                fig.show()
-
-        except Exception as err:
-            tqdm.write(f"Error when plotting '{file}': '{err}'")
-            raise
+    if workers == 1:
+        for file in tqdm(files, desc="Loading files"):
+            result = _process_file(file, local_dir, show_or_saveimg, cache, dpi, max_points)
+            if result is not None:
+                recordings[result[0]] = result[1]
+    else:
+        # headless batch export: each night is loaded and rendered in its
+        # own process, the results are collected in the order of the files
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker) as executor:
+            results = executor.map(_process_file,
+                                   files,
+                                   [local_dir] * len(files),
+                                   [show_or_saveimg] * len(files),
+                                   [cache] * len(files),
+                                   [dpi] * len(files),
+                                   [max_points] * len(files))
+            for result in tqdm(results, total=len(files), desc="Loading files"):
+                if result is not None:
+                    recordings[result[0]] = result[1]
+    assert recordings, "No recording could be loaded."
 
     df = recordings[list(recordings.keys())[-1]]
     if open_console:
@@ -220,5 +112,170 @@ def plot(show_or_saveimg="both",
         input("Press any key to exit.")  # stops the plots from exiting
 
 
+def _init_worker():
+    "make sure the processes of the pool never open a window"
+    plt.switch_backend("Agg")
+
+
+def lttb(x, y, n_out):
+    """
+    downsample the curve (x, y) to n_out points using the largest triangle
+    three buckets algorithm, which keeps the peaks that a plain decimation
+    would miss. Returns x and y unchanged if they are already short enough.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+    # the first and last points are always kept, the others are split in
+    # n_out - 2 buckets from which one point each is selected
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0] = 0
+    keep[-1] = n - 1
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        # average of the next bucket, or the last point for the last bucket
+        if i + 2 < len(edges):
+            next_x = x[stop:edges[i + 2]].mean()
+            next_y = y[stop:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        prev_x, prev_y = x[keep[i]], y[keep[i]]
+        area = np.abs((prev_x - next_x) * (y[start:stop] - prev_y)
+                      - (prev_x - x[start:stop]) * (next_y - prev_y))
+        keep[i + 1] = start + int(area.argmax())
+    return x[keep], y[keep]
+
+
+def clean_motion(df):
+    "turn the motion angle of a loaded night into a clipped activity, in place"
+    df["Motion"] /= 1000
+    df["Motion"] = df["Motion"].diff().abs()
+
+    # replace first value that got erased by abs()
+    df["Motion"] = df["Motion"].fillna(0.0)
+
+    # clip values that are too high
+    df["Motion"] = df["Motion"].clip(lower=0, upper=df["Motion"].quantile(0.95))
+
+    # compute smoothing etc if desired
+    #df["Motion"] = df["Motion"].rolling(window=4, center=True, closed='both').max()
+
+
+def _process_file(file, local_dir, show_or_saveimg, cache, dpi, max_points):
+    """load, clean and plot a single recording, returns its date and its
+    DataFrame or None if the file was ignored"""
+    # load file
+    df = load_night(file, cache=cache)
+
+    if df.attrs["corrupt"]:
+        tqdm.write(f"  Dropped {df.attrs['corrupt']} damaged rows of '{file}'.")
+
+    # ignore small files, damaged ones are kept as they might be the only
+    # copy of a night that ended with a reset of the watch
+    if len(df.index) == 0:
+        tqdm.write(f"  No data in df '{file}'. Ignoring this file.")
+        return None
+    elif len(df.index) <= 5 and df.attrs["corrupt"]:
+        tqdm.write(f"  Not enough data ({len(df.index)} elems) in damaged df '{file}'. Ignoring this file.")
+        return None
+    elif len(df.index) <= 5:
+        tqdm.write(f"  Not enough data ({len(df.index)} elems) in df '{file}'. Trashing this file.")
+        try:
+            send2trash(file)
+            cache_file = file.parent / (file.name + CACHE_SUFFIX)
+            if cache_file.exists():
+                cache_file.unlink()
+        except Exception as err:
+            tqdm.write(f"Exception when trashing '{file}': '{err}'")
+        return None
+
+    offset = df.attrs["start"]
+    recording_date = str(datetime.utcfromtimestamp(offset))
+
+    clean_motion(df)
+
+    # plot data and save to file
+    try:
+        # init plot
+        fig, ax = plt.subplots()
+        ax.set_xlabel("Time")
+        ax.set_title(f"{recording_date}  ({file.name})")
+
+        # matplotlib dates, downsampled to roughly one point per pixel
+        x = mdates.date2num(df["date"].to_numpy())
+        if max_points is None:
+            max_points = int(fig.get_figwidth() * dpi)
+
+        # plot bpm data if present
+        bpm_vals = df["BPM"].notna().to_numpy()
+        if bpm_vals.sum() >= 2:
+            #df.loc[bpm_vals, "BPM"] = df.loc[bpm_vals, "BPM"].rolling(window=10, center=True, closed='both').mean().rolling(window=3, center=True, closed='both').mean()
+            ax_bpm = ax.twinx()
+            ax_bpm.set_ylabel("BPM")
+            bpm = df["BPM"].to_numpy()[bpm_vals]
+            print(f"BPM range: {int(bpm.min())}-{int(bpm.max())}")
+            ax_bpm.plot(*lttb(x[bpm_vals], bpm, max_points),
+                        color="red",
+                        linewidth=0.5,
+                        label="BPM")
+
+        # plot motion
+        ax.plot(*lttb(x, df["Motion"].to_numpy(), max_points),
+                color="purple",
+                linewidth=1,
+                label="Motion")
+
+        # hour of the day as xlabels
+        locator = mdates.AutoDateLocator(minticks=6, maxticks=24)
+        ax.xaxis.set_major_locator(locator)
+        ax.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
+        ax.tick_params(axis="x", labelrotation=90)
+
+        # add vertical lines depending on state, all in a single call
+        ymin = df["Motion"].min()
+        ymax = df["Motion"].max()
+        assert ymin != ymax  # if equal, they are probably both np.nan
+
+        meta = df["Meta"].cat.codes.to_numpy()
+        marked = meta > 0
+        if marked.any():
+            colors = np.array([None] + [c for c, _ in _META_STYLE.values()])
+            ax.vlines(x=x[marked],
+                      ymin=ymin,
+                      ymax=ymax,
+                      colors=colors[meta[marked]],
+                      linestyle="dotted",
+                      linewidth=2.5)
+            for value, (color, label) in _META_STYLE.items():
+                if (meta == value).any():
+                    ax.plot([], [],
+                            color=color,
+                            linestyle="dotted",
+                            linewidth=2.5,
+                            label=label)
+        # save or show
+        fig.legend(fontsize=10,
+                   prop={"size": 10},
+                   )
+        if show_or_saveimg in ["saveimg", "both"]:
+            fig.savefig(f"{local_dir}/{offset}.png",
+                        bbox_inches="tight",
+                        dpi=dpi)
+            tqdm.write(f"Saved plot of '{file}' as png.")
+        if show_or_saveimg in ["show", "both"]:
+            fig.show()
+        else:
+            # pyplot keeps every figure alive until it is closed, which
+            # adds up over a long batch export
+            plt.close(fig)
+
+    except Exception as err:
+        tqdm.write(f"Error when plotting '{file}': '{err}'")
+        raise
+
+    return recording_date, df
+
+
 if __name__ == "__main__":
     Fire(plot)
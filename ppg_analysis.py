@@ -0,0 +1,181 @@
+"""
+heart rate and heart rate variability computed on the computer from the raw
+readings of the heart rate sensor, stored by SleepTk in T_F_V.ppg when
+_RAW_PPG is enabled. All the readings of a night are processed at once.
+
+Each record of a .ppg file is little endian:
+    uint32: seconds between the start of the tracking and the reading
+    uint16: number of samples n
+    n * uint32: raw values of the sensor sampled at PPG_FREQ Hz, which
+        take 18 bits
+"""
+
+import struct
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from fire import Fire
+
+from night_loader import parse_filename
+
+PPG_FREQ = 24  # samples per second, 3 per tick of 8Hz
+RECORD_HEADER = struct.Struct("<IH")
+
+# heart rates outside of this range are ignored
+MIN_BPM = 35
+MAX_BPM = 180
+
+
+def load_ppg(path):
+    """returns the start of each reading in seconds since the start of the
+    tracking and a 2D float array of the readings, padded with NaN. A
+    record truncated by the end of the file is ignored"""
+    data = Path(path).read_bytes()
+    times, windows = [], []
+    pos = 0
+    while pos + RECORD_HEADER.size <= len(data):
+        t, n = RECORD_HEADER.unpack_from(data, pos)
+        pos += RECORD_HEADER.size
+        if pos + 4 * n > len(data):
+            break
+        times.append(t)
+        windows.append(np.frombuffer(data, dtype="<u4", count=n, offset=pos))
+        pos += 4 * n
+    length = max((len(w) for w in windows), default=0)
+    out = np.full((len(windows), length), np.nan)
+    for i, w in enumerate(windows):
+        out[i, :len(w)] = w
+    return np.array(times, dtype=np.int64), out
+
+
+def _detrend(windows, freq):
+    """remove the slow variations of the signal by subtracting a moving
+    average of one second, NaN are replaced by 0 afterwards"""
+    k = freq
+    filled = np.where(np.isnan(windows), np.nanmean(windows, axis=1, keepdims=True), windows)
+    csum = np.cumsum(np.pad(filled, ((0, 0), (k // 2 + 1, k - k // 2 - 1)), mode="edge"), axis=1)
+    trend = (csum[:, k:] - csum[:, :-k]) / k
+    out = filled - trend
+    out[np.isnan(windows)] = 0
+    return out
+
+
+def heart_rate(windows, freq=PPG_FREQ):
+    """heart rate of each reading from the dominant frequency of its
+    spectrum, and the fraction of the power of the heart rate band in that
+    peak as a quality indicator between 0 and 1"""
+    if len(windows) == 0:
+        return np.zeros(0), np.zeros(0)
+    signal = _detrend(windows, freq) * np.hanning(windows.shape[1])
+    n_fft = max(1024, windows.shape[1])
+    power = np.abs(np.fft.rfft(signal, n=n_fft, axis=1)) ** 2
+    freqs = np.fft.rfftfreq(n_fft, d=1 / freq)
+    band = (freqs >= MIN_BPM / 60) & (freqs <= MAX_BPM / 60)
+    power = power[:, band]
+    band_freqs = freqs[band]
+    peak = power.argmax(axis=1)
+    # sharp pulses put a lot of power in the first harmonic: the half
+    # frequency is preferred when it also has a strong peak
+    rows = np.arange(len(peak))
+    half = np.searchsorted(band_freqs, band_freqs[peak] / 2)
+    near = np.clip(half[:, None] + np.arange(-2, 3), 0, power.shape[1] - 1)
+    half_peak = near[rows, power[rows[:, None], near].argmax(axis=1)]
+    use_half = ((band_freqs[peak] / 2 >= band_freqs[0])
+                & (power[rows, half_peak] >= 0.3 * power[rows, peak]))
+    peak = np.where(use_half, half_peak, peak)
+    bpm = band_freqs[peak] * 60
+    total = power.sum(axis=1)
+    # power around the peak, the hanning window spreads it over a few bins
+    idx = np.clip(peak[:, None] + np.arange(-3, 4), 0, power.shape[1] - 1)
+    quality = np.divide(np.take_along_axis(power, idx, axis=1).sum(axis=1), total,
+                        out=np.zeros(len(total)), where=total > 0)
+    return bpm, quality
+
+
+def beat_times(windows, bpm, freq=PPG_FREQ):
+    """list of arrays of the time in seconds of each beat of each reading,
+    using local maxima at least 60% of a beat apart and 30% as high as the
+    highest one, refined with a parabola to get below the sampling period"""
+    signal = _detrend(windows, freq)
+    # smooth over 3 samples to remove the quantization noise
+    signal = (np.roll(signal, 1, axis=1) + signal + np.roll(signal, -1, axis=1)) / 3
+    beats = []
+    for s, b in zip(signal, bpm):
+        half = max(int(0.6 * 60 / b * freq / 2), 1)
+        padded = np.pad(s, half, mode="constant", constant_values=-np.inf)
+        neighbourhood = np.lib.stride_tricks.sliding_window_view(padded, 2 * half + 1).max(axis=1)
+        # small bumps between two beats are noise
+        peaks = np.flatnonzero((s == neighbourhood) & (s > 0.3 * s.max()))
+        peaks = peaks[(peaks > 0) & (peaks < len(s) - 1)]
+        left, center, right = s[peaks - 1], s[peaks], s[peaks + 1]
+        denominator = left - 2 * center + right
+        shift = np.divide(0.5 * (left - right), denominator,
+                          out=np.zeros(len(peaks)), where=denominator != 0)
+        beats.append((peaks + np.clip(shift, -0.5, 0.5)) / freq)
+    return beats
+
+
+def rmssd(beats):
+    """root mean square of the successive differences of the beat
+    intervals in milliseconds, NaN with fewer than 4 beats"""
+    out = np.full(len(beats), np.nan)
+    for i, b in enumerate(beats):
+        if len(b) >= 4:
+            out[i] = np.sqrt(np.mean(np.diff(np.diff(b)) ** 2)) * 1000
+    return out
+
+
+def analyze_ppg(path, min_quality=0.3):
+    """
+    DataFrame of the readings of a .ppg file with the columns:
+        Timestamp: seconds since the start of the tracking
+        UNIX_time: int
+        BPM: float, NaN if the quality is below min_quality
+        RMSSD: float, in milliseconds, NaN if the quality is below
+            min_quality or not enough beats were found
+        quality: float, see heart_rate
+    """
+    path = Path(path)
+    start, interval, version = parse_filename(path)
+    times, windows = load_ppg(path)
+    bpm, quality = heart_rate(windows)
+    hrv = rmssd(beat_times(windows, bpm)) if len(windows) else np.zeros(0)
+    valid = quality >= min_quality
+    df = pd.DataFrame({
+        "Timestamp": times,
+        "UNIX_time": times + start,
+        "BPM": np.where(valid, bpm, np.nan),
+        "RMSSD": np.where(valid, hrv, np.nan),
+        "quality": quality,
+        })
+    df.attrs.update({"start": start, "interval": interval, "version": version, "path": str(path)})
+    return df
+
+
+def summary(local_dir="remote_files/logs/sleep", min_quality=0.3):
+    """
+    print the heart rate and heart rate variability of each night that has
+    raw heart rate readings
+
+    Parameters
+    ----------
+    local_dir: str, default "remote_files/logs/sleep"
+        directory containing the logs
+    min_quality: float, default 0.3
+        readings whose quality is below are ignored
+    """
+    files = sorted(Path(local_dir).glob("*.ppg"))
+    assert files, f"No .ppg files found in '{local_dir}'"
+    print(f"{'file':<25} {'readings':>8} {'valid':>6} {'BPM':>6} {'min':>5} {'max':>5} {'RMSSD':>7}")
+    for f in files:
+        df = analyze_ppg(f, min_quality)
+        valid = df["BPM"].notna()
+        if valid.any():
+            print(f"{f.name:<25} {len(df):>8} {valid.sum():>6} {df['BPM'].median():>6.1f} "
+                  f"{df['BPM'].min():>5.0f} {df['BPM'].max():>5.0f} {df['RMSSD'].median():>7.1f}")
+        else:
+            print(f"{f.name:<25} {len(df):>8} {0:>6}")
+
+
+if __name__ == "__main__":
+    Fire(summary)
@@ -0,0 +1,122 @@
+"""
+small SQLite index stored in the directory of the sleep logs, recording
+what was pulled from the watch so that the next runs can decide what to do
+with each remote file without looking at the local files, and that can be
+used as a catalog of the nights by the analysis tools
+"""
+
+import sqlite3
+import time
+from pathlib import Path
+from datetime import datetime
+
+INDEX_NAME = "pull_index.sqlite"
+
+
+class PullIndex:
+    """
+    index of the nights of a local directory, one row per log with:
+        name: filename of the log, T_F_V.csv, or T_F_V.ppg for the raw
+            heart rate readings
+        size: size of the log on the watch when it was last listed
+        checksum: adler32 checksum computed by the watch, empty until the
+            log is verified
+        verified: 1 if the local file was checked against size and checksum
+        pulled_at: unix time of the verification
+        remote_deleted: 1 if the log was then deleted from the watch
+    """
+    def __init__(self, local_dir):
+        Path(local_dir).mkdir(parents=True, exist_ok=True)
+        self.path = Path(local_dir) / INDEX_NAME
+        self.db = sqlite3.connect(str(self.path))
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS nights ("
+            "name TEXT PRIMARY KEY, "
+            "size INTEGER NOT NULL, "
+            "checksum TEXT NOT NULL, "
+            "verified INTEGER NOT NULL DEFAULT 0, "
+            "pulled_at REAL, "
+            "remote_deleted INTEGER NOT NULL DEFAULT 0)")
+        self.db.commit()
+
+    def get(self, name):
+        "row of a night as a dict, or None if it was never seen"
+        row = self.db.execute(
+            "SELECT * FROM nights WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def is_synced(self, name, size):
+        """True if a log with this exact size was already pulled and
+        verified, the logs only grow so their size is enough to tell"""
+        row = self.get(name)
+        return (row is not None
+                and row["verified"] == 1
+                and row["size"] == size)
+
+    def seen(self, name, size, checksum=""):
+        """remember the size and checksum of a remote log that is not pulled
+        yet, the checksum being empty if unknown"""
+        self.db.execute(
+            "INSERT INTO nights (name, size, checksum) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET size = excluded.size, "
+            "checksum = excluded.checksum, verified = 0",
+            (name, size, checksum))
+        self.db.commit()
+
+    def verified(self, name, size, checksum):
+        "record that the local copy of a log matches the remote one"
+        self.db.execute(
+            "INSERT INTO nights (name, size, checksum, verified, pulled_at) "
+            "VALUES (?, ?, ?, 1, ?) "
+            "ON CONFLICT(name) DO UPDATE SET size = excluded.size, "
+            "checksum = excluded.checksum, verified = 1, "
+            "pulled_at = excluded.pulled_at, remote_deleted = 0",
+            (name, size, checksum, time.time()))
+        self.db.commit()
+
+    def remote_deleted(self, name):
+        "record that a log was deleted from the watch"
+        self.db.execute(
+            "UPDATE nights SET remote_deleted = 1 WHERE name = ?", (name,))
+        self.db.commit()
+
+    def forget(self, name):
+        "remove a night from the index, for example if its local file is gone"
+        self.db.execute("DELETE FROM nights WHERE name = ?", (name,))
+        self.db.commit()
+
+    def catalog(self, verified_only=True):
+        """list of the nights as dicts, sorted by start time, with the start
+        time T, the saving interval F and the version V of the filename"""
+        query = "SELECT * FROM nights"
+        if verified_only:
+            query += " WHERE verified = 1"
+        nights = []
+        for row in self.db.execute(query):
+            night = dict(row)
+            T, F, V = Path(night["name"]).stem.split("_")[:3]
+            night["start"] = int(T)
+            night["interval"] = int(F)
+            night["version"] = int(V)
+            nights.append(night)
+        return sorted(nights, key=lambda n: n["start"])
+
+    def close(self):
+        self.db.close()
+
+
+def show(local_dir="remote_files/logs/sleep"):
+    "print the catalog of the nights pulled into local_dir"
+    index = PullIndex(local_dir)
+    for night in index.catalog(verified_only=False):
+        pulled = datetime.fromtimestamp(night["pulled_at"]).isoformat(timespec="seconds") if night["pulled_at"] else "not pulled"
+        print(f"{night['name']:<25} {night['size']:>8}B  {night['checksum']}  "
+              f"started {datetime.utcfromtimestamp(night['start'])}  "
+              f"{pulled}{'  (deleted from watch)' if night['remote_deleted'] else ''}")
+    index.close()
+
+
+if __name__ == "__main__":
+    from fire import Fire
+    Fire(show)
@@ -1,14 +1,164 @@
 #!/usr/local/bin/python3
 
+import os
 import time
+import shutil
 from pathlib import Path
-import subprocess
-import shlex
 import re
+import ast
+import base64
+import zlib
+import copy
+import json
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from pprint import pprint
 from plyer import notification
 
+from watch_transport import WasptoolTransport, WatchError
+from pull_index import PullIndex
+from night_archive import NightArchive, ARCHIVE_NAME
+from sleep_cycles import estimate_cycles, cycles_setting, CYCLES_SETTING
+
+# executed on the watch: lists the sleep logs along with their size
+_MANIFEST_CODE = """
+import os
+import gc
+gc.collect()
+_sleeptk_d = "{remote_dir}"
+print("SLEEPTK_MANIFEST", repr([(n, os.stat(_sleeptk_d + n)[6]) for n in os.listdir(_sleeptk_d) if n.endswith(".csv") or n.endswith(".ppg")]))
+del _sleeptk_d
+gc.collect()
+"""
+
+# executed on the watch: adler32 checksum of a sleep log computed in small
+# chunks to spare the watch's memory, only for the logs being verified
+_CHECKSUM_CODE = """
+import gc
+gc.collect()
+def _sleeptk_adler32(path):
+    a = 1
+    s = 0
+    buf = bytearray(512)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            for i in range(n):
+                a += buf[i]
+                s += a
+            a %= 65521
+            s %= 65521
+    return "{{:04x}}{{:04x}}".format(s, a)
+print("SLEEPTK_CHECKSUM", _sleeptk_adler32("{path}"))
+del _sleeptk_adler32
+gc.collect()
+"""
+
+# executed on the watch: prints a byte range of a sleep log as base64, in
+# chunks whose size depends on the free memory of the watch. If pack is
+# True, each chunk is first packed using 4 bits per character (see _unpack)
+_READ_CODE = """
+import gc
+import ubinascii
+gc.collect()
+def _sleeptk_pack(src, n, dst, lut):
+    j = 0
+    for i in range(n):
+        c = src[i]
+        k = lut[c]
+        if k == 15:
+            v = 0xf00 | c
+            e = 3
+        else:
+            v = k
+            e = 1
+        while e:
+            e -= 1
+            k = (v >> (4 * e)) & 15
+            if j & 1:
+                dst[j >> 1] |= k
+            else:
+                dst[j >> 1] = k << 4
+            j += 1
+    return (j + 1) >> 1
+def _sleeptk_read(path, offset, stop, max_chunk, pack):
+    buf = bytearray(max(64, min(max_chunk, gc.mem_free() // 8)))
+    mv = memoryview(buf)
+    if pack:
+        lut = bytearray(b"\\x0f" * 256)
+        for k, c in enumerate(b"{table}"):
+            lut[c] = k
+        dst = bytearray(len(buf) * 3 // 2 + 1)
+        dmv = memoryview(dst)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while offset < stop:
+            n = f.readinto(mv[:min(len(buf), stop - offset)])
+            if not n:
+                break
+            if pack:
+                print("SLEEPTK_PACKED", offset, n, ubinascii.b2a_base64(dmv[:_sleeptk_pack(mv, n, dst, lut)]).decode().strip())
+            else:
+                print("SLEEPTK_DATA", offset, n, ubinascii.b2a_base64(mv[:n]).decode().strip())
+            offset += n
+    print("SLEEPTK_DONE", offset)
+_sleeptk_read("{remote_dir}{name}", {offset}, {stop}, {max_chunk}, {pack})
+del _sleeptk_read, _sleeptk_pack
+gc.collect()
+"""
+
+# executed on the watch: stores the personal sleep cycle estimates read by
+# SleepTk when it starts, see sleep_cycles.py
+_CYCLES_CODE = """
+if hasattr(wasp.system, "set") and callable(wasp.system.set):
+    wasp.system.set("{setting}", {value})
+    print("SLEEPTK_CYCLES_SET")
+"""
+
+# characters of the sleep logs that are packed as a single 4 bit code, the
+# code 15 announces a raw byte stored in the next two 4 bit codes
+_PACK_TABLE = b"0123456789,.\n-?"
+assert len(_PACK_TABLE) == 15
+
+
+def _unpack(data, size):
+    "decode the first size bytes packed by _sleeptk_pack on the watch"
+    out = bytearray()
+    nibbles = (b >> s & 15 for b in data for s in (4, 0))
+    for k in nibbles:
+        if len(out) >= size:
+            break
+        if k == 15:
+            out.append(next(nibbles) << 4 | next(nibbles))
+        else:
+            out.append(_PACK_TABLE[k])
+    if len(out) != size:
+        raise Exception(f"Packed chunk decoded to {len(out)} bytes instead of {size}")
+    return bytes(out)
+
+# suffix of the files being downloaded, renamed to the name of the remote
+# file once their size and checksum match it
+PART_SUFFIX = ".part"
+
+# statistics of every pull, stored as JSON lines in local_dir
+STATS_NAME = "pull_stats.jsonl"
+
+# smallest chunk size tried after failed transfers
+_MIN_CHUNK_SIZE = 64
+
+# number of chunks received in a row after which the chunk size is doubled
+# again, up to max_chunk_size
+_GROW_AFTER = 4
+
+# a file is given up after this many failed transfers in a row that did not
+# receive a single chunk
+_MAX_STALLS = 5
+
+
 class download_sleep_data:
     """
     simple script to download the latest sleep data from the pinetime
@@ -17,8 +167,19 @@ class download_sleep_data:
                  local_dir="remote_files/logs/sleep",
                  delete_after_dl=True,
                  delete_empty_remote_files=True,
-                 auto_reboot=False,
+                 max_chunk_size=2048,
+                 compress=False,
+                 max_concurrent=2,
+                 notify=True,
+                 daemon=False,
+                 poll_interval=60,
+                 idle_interval=1800,
+                 max_backoff=1800,
+                 transport=WasptoolTransport,
                  device=None,
+                 archive=False,
+                 push_cycles=False,
+                 on_verified=None,
                  ):
         """
         Parameters
@@ -27,81 +188,287 @@ class download_sleep_data:
             location of the directory where the files will be stored
         delete_after_dl: bool, default True
             if True, will delete the files on the pinetime after they have
-            been downloaded. If both files are not the same size, the local
+            been downloaded. If both files are not the same size or their
+            checksums computed on the watch and locally differ, the local
             file will be removed and a notification shown on the computer.
+            The watch only computes the checksum of the files just pulled,
+            the ones already verified with the same size are skipped.
+            Downloads go to T_F_V.csv.part, renamed to T_F_V.csv once
+            verified. Interrupted downloads are kept and only the missing
+            bytes are pulled on the next run, which also appends the new
+            data of remote files that grew since the last pull.
         delete_empty_remote_files: bool, default True
             if True, will remove remote files whose size is 0
-        auto_reboot: bool, default False
-            if True, will reboot the watch before every download to avoid
-            memory errors.
+        max_chunk_size: int, default 2048
+            maximum number of bytes read at once on the watch. The watch
+            further reduces it depending on its free memory. Each file starts
+            at this size, which is halved after every failed transfer instead
+            of rebooting the watch and doubled back after a few chunks
+            received in a row.
+        compress: bool, default False
+            if True, the watch packs the data before sending it, roughly
+            halving the number of bytes going through bluetooth. The
+            unpacked file is checked against the watch's checksum before
+            the remote file gets deleted.
+        max_concurrent: int, default 2
+            only used when several devices are given: maximum number of
+            watches pulled at the same time through the bluetooth adapter.
+        device: str or list
+            bluetooth ID of the watch. Either a list or a comma separated
+            string of IDs can be given to pull several watches concurrently,
+            each into its own subdirectory of local_dir.
+        notify: bool, default True
+            if False, messages are only printed instead of also being sent
+            as desktop notifications
+        daemon: bool, default False
+            if True, keep running and pull the watch as soon as it comes in
+            range and is not tracking sleep anymore, instead of pulling once.
+            Bluetooth is turned on only once for the whole session.
+        poll_interval: int, default 60
+            daemon mode: seconds between two checks for the watch, also
+            waited after a pull where every file left failed
+        idle_interval: int, default 1800
+            daemon mode: seconds to wait after a successful pull or a watch
+            without any log, as no new data is expected before the next
+            tracking session. In fleet mode this applies once any watch was
+            reached, and the backoff while any watch is tracking
+        max_backoff: int, default 1800
+            daemon mode: while the watch is tracking sleep, the delay between
+            two checks doubles from poll_interval up to max_backoff seconds
+        transport: callable, default WasptoolTransport
+            called with a device ID to get the object used to talk to the
+            watch, see watch_transport.py. For example a FakeWatchTransport
+            can be used to run the pipeline without a watch.
+        archive: bool, default False
+            if True, the verified nights are appended to the memory mapped
+            archive in the 'archive' subdirectory of local_dir after each
+            pull, see night_archive.py
+        push_cycles: bool, default False
+            if True, the sleep cycle length and time to fall asleep are
+            estimated from the archive after each pull and sent to the
+            watch, where SleepTk uses them instead of _CYCLE_LENGTH to
+            suggest wake up times. Needs archive to be True, see
+            sleep_cycles.py
+        on_verified: callable, default None
+            called with the path of each local file as soon as it is
+            downloaded and verified, while the next files are still being
+            pulled, see sleep_pipeline.py
         """
         assert device, "device bluetooth ID has to be set"
+        assert archive or not push_cycles, "push_cycles needs archive to be True"
+        if isinstance(device, str) and "," in device:
+            device = [d.strip() for d in device.split(",") if d.strip()]
+        self.device = device
+        self.local_dir = local_dir
+        self.delete_after_dl = delete_after_dl
+        self.delete_empty_remote_files = delete_empty_remote_files
+        self.max_chunk_size = max_chunk_size
+        self.compress = compress
+        self.notify = notify
+        self.transport_factory = transport
+        self.retries = 0  # number of failed transfers that were retried
+        self.prefix = ""  # prepended to messages to tell watches apart
+        self.position = None  # line of the progress bar in fleet mode
+        self.daemon = daemon
+        self.archive = archive
+        self.push_cycles = push_cycles
+        self.on_verified = on_verified
+        # outcome of the last pull: "absent", "tracking", "empty", "done",
+        # or "failed" if no file could be pulled while some were left
+        self.status = None
+
+        if isinstance(device, (list, tuple)):
+            assert max_concurrent > 0, "Wrong max_concurrent value"
+        if daemon:
+            assert 0 < poll_interval <= max_backoff, "Wrong poll_interval or max_backoff value"
+            self.run_daemon(max_concurrent, poll_interval, idle_interval, max_backoff)
+        elif isinstance(device, (list, tuple)):
+            self.pull_fleet(max_concurrent)
+        else:
+            self.pull()
+
+    def run_daemon(self, max_concurrent, poll_interval, idle_interval, max_backoff):
+        """pull the watch whenever it is in range and done tracking, until
+        interrupted"""
+        self.n("Starting sync daemon")
+        busy_delay = poll_interval
+        while True:
+            self.status = None
+            try:
+                if isinstance(self.device, (list, tuple)):
+                    self.pull_fleet(max_concurrent)
+                else:
+                    self.pull()
+            except SystemExit:
+                pass
+            except Exception as err:
+                self.n(f"Error during pull: '{err}'")
+
+            if self.status == "tracking":
+                # the watch is busy: check less and less often
+                delay = busy_delay
+                busy_delay = min(busy_delay * 2, max_backoff)
+            else:
+                # no new night can appear before the next tracking session
+                busy_delay = poll_interval
+                delay = idle_interval if self.status in ["done", "empty"] else poll_interval
+            self.write(f"Next check in {delay}s")
+            time.sleep(delay)
+
+    def pull_fleet(self, max_concurrent):
+        """pull every watch of self.device concurrently, at most
+        max_concurrent at a time"""
+        self.n(f"Starting fleet pull of {len(self.device)} watches", do_notify=not self.daemon)
+        try:
+            for device in self.device:
+                self.transport_factory(device).prepare()
+        except Exception as err:
+            self.n(f"Could not turn on bluetooth:\r'{err}'")
+            raise SystemExit()
+
+        def worker(position, device):
+            puller = copy.copy(self)
+            puller.device = device
+            puller.local_dir = f"{self.local_dir}/{device.replace(':', '-')}"
+            puller.prefix = f"[{device}] "
+            puller.position = position
+            try:
+                puller.pull()
+            except SystemExit:
+                pass
+            except Exception as err:
+                puller.n(f"Error: '{err}'")
+                return f"error: '{err}'"
+            return puller.status
+
+        with ThreadPoolExecutor(max_workers=max_concurrent) as pool:
+            results = dict(zip(
+                self.device,
+                pool.map(worker, range(len(self.device)), self.device)))
+        self.n("Fleet pull finished:\r" + "\r".join(
+            f"{device}: {result}" for device, result in results.items()),
+            do_notify=not self.daemon)
+
+        # status of the fleet for the daemon: retrying soon while any watch
+        # has files left to pull, busy while any watch is tracking, idle
+        # once any watch was reached
+        statuses = set(results.values())
+        if "failed" in statuses:
+            self.status = "failed"
+        elif "tracking" in statuses:
+            self.status = "tracking"
+        elif "done" in statuses:
+            self.status = "done"
+        elif "empty" in statuses:
+            self.status = "empty"
+        else:
+            self.status = "absent"
+
+    def pull(self):
+        """download the sleep data of a single watch, then append the timing
+        of each stage to pull_stats.jsonl in local_dir"""
+        self.timings = {}  # seconds spent in each stage
+        self.counters = {"files": 0, "bytes": 0, "link_chars": 0, "retries": 0}
+        started = datetime.now()
+        start = time.perf_counter()
+        try:
+            self._pull()
+        finally:
+            # in daemon mode most runs only find that the watch is absent
+            if not (self.daemon and self.status == "absent"):
+                self._save_stats(started, time.perf_counter() - start)
+
+    def _save_stats(self, started, duration):
+        "append the statistics of the last run to pull_stats.jsonl"
+        stats = {
+            "started": started.isoformat(timespec="seconds"),
+            "device": self.device,
+            "status": self.status,
+            "duration": round(duration, 3),
+            "stages": {k: round(v, 3) for k, v in self.timings.items()},
+            **self.counters,
+        }
+        pull_time = self.timings.get("pull", 0)
+        stats["bytes_per_s"] = round(self.counters["bytes"] / pull_time, 1) if pull_time else None
+        try:
+            Path(self.local_dir).mkdir(parents=True, exist_ok=True)
+            with open(Path(self.local_dir) / STATS_NAME, "a") as f:
+                f.write(json.dumps(stats) + "\n")
+        except Exception as err:
+            self.write(f"Could not save pull statistics: '{err}'")
+
+    @contextmanager
+    def _timed(self, stage):
+        "add the time spent in the with block to the timing of stage"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
+    def _pull(self):
+        self.transport = self.transport_factory(self.device)
+        local_dir = self.local_dir
+
         # checking if watch is nearby and bluetooth is on
-        self.n(f"Starting")
+        self.n(f"Starting", do_notify=not self.daemon)
         try:
-            subprocess.check_output(
-                shlex.split(
-                    'bluetooth on')).decode()
-            time.sleep(3)
-            subprocess.check_output(
-                shlex.split(
-                    f'./tools/wasptool --device {device} --verbose --battery')).decode()
+            with self._timed("connect"):
+                self.transport.prepare()
+                self.transport.battery()
         except Exception as err:
-            self.n(f"Watch is not nearby?\rException:\r\r'{err}'")
+            self.status = "absent"
+            self.n(f"Watch is not nearby?\rException:\r\r'{err}'", do_notify=not self.daemon)
             raise SystemExit()
 
         # garbage collection
         self.n("\n\nRunning gc.collect()...", do_notify=False)
-        subprocess.check_output(
-            shlex.split(
-                f'./tools/wasptool --device {device} --verbose --eval \'wasp.gc.collect()\'')).decode()
+        self._remote_gc()
 
         # checking if SleepTk is running
-        out = subprocess.check_output(
-                shlex.split(f'./tools/wasptool --device {device} --verbose --eval \"if hasattr(wasp, \'_SleepTk_tracking\') and wasp._SleepTk_tracking == 1: print(\'SleepTk is tracking\')\"'
-                )).decode()
-        if "SleepTk is tracking" in out.split("\r\r\n"):
-            self.n(f"Watch is currently recording Sleep data. Exiting.")
+        with self._timed("tracking_check"):
+            out = self.transport.eval(
+                "if hasattr(wasp, '_SleepTk_tracking') and wasp._SleepTk_tracking == 1: print('SleepTk is tracking')")
+        if "SleepTk is tracking" in [l.strip() for l in out.splitlines()]:
+            self.status = "tracking"
+            self.n(f"Watch is currently recording Sleep data. Exiting.", do_notify=not self.daemon)
             raise SystemExit()
 
-        # listing remote files
+        # listing remote files along with their size
         self.n("\n\nListing remote files...", do_notify=False)
-        out = subprocess.check_output(
-            shlex.split(
-                f'./tools/wasptool --device {device} --verbose --eval \'from shell import ls ; ls(\"/flash/logs/sleep/\")\''
-                )).decode()
-        flines = [l.strip().split(" ") for l in out.split("\r\r\n") if l.endswith(".csv")]
-        if len(flines) <= 0:
-            self.n(f"No remote files found!")
+        manifest = self._remote_manifest()
+        if len(manifest) <= 0:
+            self.status = "empty"
+            self.n(f"No remote files found!", do_notify=not self.daemon)
             raise SystemExit()
 
-        # getting remote file size
-        size_dict = {l[1]: int(l[0]) for l in flines}
-        self.n(f"Found {len(size_dict.keys())} remote files")
-        pprint(size_dict)
+        size_dict = dict(manifest)
+        self.n(f"Found {len(size_dict.keys())} remote files", do_notify=not self.daemon)
+        if self.position is None:
+            pprint(manifest)
 
         # remote empty remote files
-        if 0 in size_dict.values() and delete_empty_remote_files:
+        if 0 in size_dict.values() and self.delete_empty_remote_files:
             to_remove = []
             for file, size in tqdm(size_dict.items(),
-                                   desc="Removing empty remote files"):
+                                   desc=f"{self.prefix}Removing empty remote files",
+                                   position=self.position):
                 if size == 0:
                     self.n(f"Removing '{file}'", do_notify=False)
                     try:
-                        out = subprocess.check_output(
-                            shlex.split(
-                                f'./tools/wasptool --device {device} --verbose --eval \'from shell import rm ; rm(\"/flash/logs/sleep/{file}\")\''
-                                )).decode()
+                        self._remote_rm(file)
                     except Exception as err:
                         self.n(f"Watch reported error: '{err}'")
-                        breakpoint()
+                        continue
                     to_remove.append(file)
                     self.n(f"Removed remote file: '{file}'")
             for tr in to_remove:
                 size_dict.pop(tr)
+                manifest.pop(tr)
 
         if len(size_dict.keys()) == 0:
-            self.n("No remote files to download.")
+            self.status = "empty"
+            self.n("No remote files to download.", do_notify=not self.daemon)
             raise SystemExit()
         else:
             to_dl = size_dict.keys()
@@ -109,70 +476,243 @@ class download_sleep_data:
         # download remote files
         print("\n\n")
         Path(local_dir).mkdir(parents=True, exist_ok=True)
-        for fi in tqdm(to_dl):
+        index = PullIndex(local_dir)
+        verified = failed = 0
+        for fi in tqdm(to_dl, desc=self.prefix or None, position=self.position):
             lfi = Path(f"{local_dir}/{fi}")
+            remote_size = manifest[fi]
+
+            # already pulled and verified by a previous run, the logs only
+            # grow so their size is enough to tell
+            if index.is_synced(fi, remote_size) and lfi.exists() and lfi.stat().st_size == remote_size:
+                if self.delete_after_dl:
+                    self._remote_rm(fi)
+                    index.remote_deleted(fi)
+                    self.write(f"Deleted already pulled remote: '{fi}'")
+                else:
+                    self.write(f"File '{fi}' is already pulled")
+                continue
+            index.seen(fi, remote_size)
+
+            # the download goes to a .part file renamed once verified, so that
+            # the other tools never see a partial night
+            part = lfi.with_name(lfi.name + PART_SUFFIX)
 
             # remove local file if already exists and size is 0
             if lfi.exists() and lfi.stat().st_size == 0:
                 lfi.unlink()
-
-            if lfi.exists():
-                tqdm.write(f"File '{fi}' already exists, you should investigate")
+            if lfi.exists() and lfi.stat().st_size > remote_size:
+                self.write(f"Local file '{fi}' is larger than the remote one, you should investigate")
                 continue
-            else:
-                if auto_reboot:
-                    tqdm.write("Restarting watch and waiting 10s...")
-                    out = subprocess.check_output(
-                        shlex.split(
-                            f'./tools/wasptool --device {device} --verbose --reset'
-                            ))
-                    time.sleep(10)
-                tqdm.write(f"Downloading file '{fi}'")
+            if lfi.exists() and not part.exists():
+                # the remote file grew since the last pull: the verified
+                # local copy is kept until the longer one is verified
+                shutil.copyfile(lfi, part)
+
+            local_size = part.stat().st_size if part.exists() else 0
+            if local_size > remote_size:
+                self.write(f"Partial file '{part.name}' is larger than the remote one, pulling it again.")
+                part.unlink()
+                local_size = 0
+
+            if local_size < remote_size:
+                if local_size:
+                    self.write(f"Resuming download of file '{fi}' from byte {local_size}/{remote_size}")
+                else:
+                    self.write(f"Downloading file '{fi}'")
                 try:
-                    out = subprocess.check_output(
-                        shlex.split(
-                            f'./tools/wasptool --device {device} --verbose --pull "logs/sleep/{fi}" --as "{local_dir}/{fi}"'
-                            ))
-                    if b"MemoryError" in out:
-                        raise Exception("Memory error from watch.")
-                    if b"Watch reported error" in out:
-                        raise Exception("Watch reported error")
-                    tqdm.write(f"Succesfully downloaded to './logs/sleep/{fi}'")
+                    self._pull_range(fi, local_size, remote_size, part)
+                    self.counters["files"] += 1
+                    self.write(f"Succesfully downloaded to '{lfi}'")
                 except Exception as err:
-                    tqdm.write(f"Error happened while downloading {fi}, deleting local incomplete file: '{err}'")
-                    if lfi.exists():
-                        lfi.unlink()
-                    breakpoint()
-
-                remote_size = size_dict[fi]
-                local_size = lfi.stat().st_size
-                if remote_size != local_size:
-                    tqdm.write(f"Size mismatch for '{fi}':\rlocal: '{local_size}'\rremote: '{remote_size}'\rDeleting local file.")
-                    if lfi.exists():
-                        lfi.unlink()
-                else:
-                    if delete_after_dl:
-                        tqdm.write(f"Downloaded remote file: '{fi}'")
-                        out = subprocess.check_output(
-                            shlex.split(
-                                f'./tools/wasptool --device {device} --verbose --eval \'from shell import rm ; rm(\"/flash/logs/sleep/{fi}\")\''
-                                )).decode()
-                        tqdm.write(f"Deleted remote: '{fi}'")
+                    # the partial file is kept to resume from it next time
+                    # the daemon retries within poll_interval, notifying
+                    # each attempt would show a popup every minute
+                    self.n(f"Error happened while downloading {fi}, will resume next time: '{err}'", do_notify=not self.daemon)
+                    failed += 1
+                    continue
+
+            # the checksum is only computed by the watch for the logs that
+            # were just pulled, a mismatching .part is pulled again next time
+            local_size = part.stat().st_size
+            remote_checksum = local_checksum = None
+            if remote_size == local_size:
+                try:
+                    remote_checksum = self._remote_checksum(fi)
+                except Exception as err:
+                    # the downloaded file is kept to verify it next time
+                    self.n(f"Error happened while verifying {fi}, will retry next time: '{err}'", do_notify=not self.daemon)
+                    failed += 1
+                    continue
+                local_checksum = self._local_checksum(part)
+            if remote_size != local_size:
+                self.write(f"Size mismatch for '{fi}':\rlocal: '{local_size}'\rremote: '{remote_size}'\rDeleting local file.")
+                part.unlink()
+                failed += 1
+            elif remote_checksum != local_checksum:
+                self.write(f"Checksum mismatch for '{fi}':\rlocal: '{local_checksum}'\rremote: '{remote_checksum}'\rDeleting local file.")
+                part.unlink()
+                failed += 1
+            else:
+                os.replace(part, lfi)
+                index.verified(fi, remote_size, remote_checksum)
+                verified += 1
+                if self.on_verified is not None:
+                    self.on_verified(lfi)
+                if self.delete_after_dl:
+                    self.write(f"Downloaded remote file: '{fi}'")
+                    self._remote_rm(fi)
+                    index.remote_deleted(fi)
+                    self.write(f"Deleted remote: '{fi}'")
 
             self.n("Running gc.collect()...", do_notify=False)
-            subprocess.check_output(
-                shlex.split(
-                    f'./tools/wasptool --device {device} --verbose --eval \'wasp.gc.collect()\'')).decode()
+            self._remote_gc()
 
             print("\n\n")
+        index.close()
+
+        if self.archive:
+            added = NightArchive(Path(local_dir) / ARCHIVE_NAME).update(local_dir)
+            self.write(f"Added {added} nights to the archive")
+        if self.push_cycles:
+            self._push_cycles()
+        # the daemon retries soon when all the files left failed
+        self.status = "failed" if failed and not verified else "done"
+
+    def _push_cycles(self):
+        "send the sleep cycle estimates of the archive to the watch"
+        estimates = estimate_cycles(Path(self.local_dir) / ARCHIVE_NAME)
+        if estimates["cycle_length"] is None and estimates["latency"] is None:
+            self.write(f"Not enough nights to estimate the sleep cycles ({estimates['nights']} usable)")
+            return
+        value = cycles_setting(estimates)
+        try:
+            with self._timed("push_cycles"):
+                out = self.transport.exec(_CYCLES_CODE.format(setting=CYCLES_SETTING, value=value))
+        except Exception as err:
+            self.write(f"Could not send the sleep cycles to the watch: '{err}'")
+            return
+        # whole lines only, wasptool can echo the code that was sent
+        if "SLEEPTK_CYCLES_SET" in [l.strip() for l in out.splitlines()]:
+            self.write(f"Sent sleep cycles to the watch: {value[0]} min per cycle, {value[1]} min to fall asleep")
+        else:
+            self.write("The watch does not support wasp.system.set, sleep cycles not sent")
+
+    def _remote_rm(self, fi):
+        "delete a sleep log on the watch"
+        with self._timed("rm"):
+            self.transport.eval(f'from shell import rm ; rm("{self.transport.remote_dir}{fi}")')
+
+    def _remote_gc(self):
+        "free memory on the watch"
+        with self._timed("gc"):
+            self.transport.eval("wasp.gc.collect()")
+
+    def _remote_manifest(self):
+        """list the remote sleep logs in a single round trip. Returns a dict
+        mapping each filename to its size"""
+        with self._timed("ls"):
+            out = self.transport.exec(_MANIFEST_CODE.format(remote_dir=self.transport.remote_dir))
+        for line in out.splitlines():
+            line = line.strip()
+            if line.startswith("SLEEPTK_MANIFEST "):
+                entries = ast.literal_eval(line[len("SLEEPTK_MANIFEST "):])
+                return {name: int(size) for name, size in entries}
+        raise Exception(f"Could not find the file manifest in the watch output: '{out}'")
+
+    def _remote_checksum(self, fi):
+        "adler32 checksum of a remote sleep log, computed by the watch"
+        with self._timed("verify"):
+            out = self.transport.exec(_CHECKSUM_CODE.format(path=self.transport.remote_dir + fi))
+        for line in out.splitlines():
+            line = line.strip()
+            if line.startswith("SLEEPTK_CHECKSUM "):
+                return line[len("SLEEPTK_CHECKSUM "):]
+        raise Exception(f"Could not find the checksum of '{fi}' in the watch output: '{out}'")
+
+    def _pull_range(self, fi, start, stop, lfi):
+        """download the bytes [start, stop[ of remote file fi and append them
+        to the local file lfi, which must currently be start bytes long.
+        Each failed transfer keeps the chunks received so far and is retried
+        with halved chunks, down to _MIN_CHUNK_SIZE. The chunk size grows
+        back after _GROW_AFTER chunks received in a row, and the file is
+        only given up after _MAX_STALLS failed transfers in a row without
+        any progress."""
+        offset = start
+        transferred = 0
+        chunk_size = self.max_chunk_size
+        stalls = 0
+        while True:
+            previous = offset
+            chunks = 0
+            code = _READ_CODE.format(
+                remote_dir=self.transport.remote_dir,
+                name=fi,
+                offset=offset,
+                stop=stop,
+                max_chunk=chunk_size,
+                # the .ppg files are binary and would not shrink
+                pack=bool(self.compress) and fi.endswith(".csv"),
+                table=repr(_PACK_TABLE)[2:-1])
+            with self._timed("pull"):
+                try:
+                    out = self.transport.exec(code)
+                    err = None
+                except WatchError as e:
+                    out = e.out
+                    err = e
+            with open(lfi, "ab") as f:
+                assert f.tell() == offset, f"Local file '{lfi}' is not {offset} bytes long"
+                for line in out.splitlines():
+                    line = line.strip()
+                    if line.startswith(("SLEEPTK_DATA ", "SLEEPTK_PACKED ")):
+                        marker, chunk_offset, size, data = line.split(" ", 3)
+                        if int(chunk_offset) != offset:
+                            break
+                        transferred += len(data)
+                        data = base64.b64decode(data)
+                        if marker == "SLEEPTK_PACKED":
+                            data = _unpack(data, int(size))
+                        f.write(data)
+                        offset += len(data)
+                        chunks += 1
+                        if chunks % _GROW_AFTER == 0:
+                            chunk_size = min(chunk_size * 2, self.max_chunk_size)
+                        self.counters["bytes"] += len(data)
+                        self.counters["link_chars"] += len(line)
+            if offset >= stop:
+                self.write(f"Received {transferred} base64 characters for {stop - start} bytes of '{fi}'")
+                return
+            if err is None:
+                raise Exception(f"Remote file '{fi}' ended at byte {offset} instead of {stop}")
+            stalls = 0 if offset > previous else stalls + 1
+            if stalls >= _MAX_STALLS:
+                raise err
+            chunk_size = max(chunk_size // 2, _MIN_CHUNK_SIZE)
+            self.retries += 1
+            self.counters["retries"] += 1
+            self.write(f"Transfer of '{fi}' interrupted at byte {offset}/{stop} ('{err}'), retrying with chunks of {chunk_size} bytes")
+
+    def _local_checksum(self, path):
+        "adler32 checksum of a local file, formatted like the watch does"
+        checksum = 1
+        with self._timed("verify"):
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    checksum = zlib.adler32(chunk, checksum)
+        return f"{checksum:08x}"
+
+    def write(self, message):
+        "print a message without breaking the progress bars"
+        tqdm.write(f"{self.prefix}{message}")
 
     def n(self, message, do_print=True, do_notify=True):
         "create notification to computer"
         try:
             if do_print:
-                tqdm.write(message)
-            if do_notify:
-                notification.notify(title="SleepTk pull",
+                self.write(message)
+            if do_notify and self.notify:
+                notification.notify(title=f"{self.prefix}SleepTk pull",
                                     message=message,
                                     timeout=5)
         except Exception as err:
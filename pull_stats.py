@@ -0,0 +1,89 @@
+"""
+summary of the statistics saved by pull_sleep_data.py after every pull, to
+spot if the bluetooth link, the watch memory or a given stage of the pull
+is getting slower over time
+"""
+
+import json
+from pathlib import Path
+from statistics import median
+
+from pull_sleep_data import STATS_NAME
+
+STAGES = ["connect", "gc", "tracking_check", "ls", "pull", "verify", "rm", "push_cycles"]
+
+
+def load_stats(local_dir):
+    "list of the statistics of every pull saved in local_dir, oldest first"
+    path = Path(local_dir) / STATS_NAME
+    if not path.exists():
+        return []
+    runs = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    runs.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line can be truncated if a pull was killed
+                    continue
+    return sorted(runs, key=lambda r: r["started"])
+
+
+def summary(local_dir="remote_files/logs/sleep",
+            last=20,
+            window=5,
+            threshold=1.5,
+            ):
+    """
+    print the timing of the last pulls and compare the recent ones to the
+    older ones
+
+    Parameters
+    ----------
+    local_dir: str, default "remote_files/logs/sleep"
+        directory where the pulls saved their statistics
+    last: int, default 20
+        number of pulls to show
+    window: int, default 5
+        number of most recent pulls compared to all the previous ones
+    threshold: float, default 1.5
+        a stage whose median time of the recent pulls is more than
+        threshold times the median of the previous pulls is reported as
+        regressing
+    """
+    runs = load_stats(local_dir)
+    assert runs, f"No pull statistics found in '{local_dir}'"
+
+    print(f"{'started':<20} {'status':<9} {'total':>7} " + " ".join(f"{s[:8]:>8}" for s in STAGES) + f" {'bytes':>8} {'bytes/s':>8} {'retries':>7}")
+    for r in runs[-last:]:
+        stages = " ".join(f"{r['stages'].get(s, 0):>8.2f}" for s in STAGES)
+        bps = f"{r['bytes_per_s']:>8.0f}" if r.get("bytes_per_s") else f"{'-':>8}"
+        print(f"{r['started']:<20} {str(r['status']):<9} {r['duration']:>7.2f} {stages} {r['bytes']:>8} {bps} {r['retries']:>7}")
+
+    # only pulls that did download something are comparable
+    done = [r for r in runs if r["status"] == "done"]
+    if len(done) <= window:
+        print(f"\nNot enough completed pulls to look for trends (need more than {window}).")
+        return
+    recent, previous = done[-window:], done[:-window]
+    print(f"\nMedian of the last {window} completed pulls compared to the {len(previous)} previous ones:")
+    for s in STAGES + ["bytes_per_s"]:
+        if s == "bytes_per_s":
+            get = lambda r: r.get("bytes_per_s")
+        else:
+            get = lambda r: r["stages"].get(s)
+        new = [get(r) for r in recent if get(r) is not None]
+        old = [get(r) for r in previous if get(r) is not None]
+        if not new or not old or median(old) == 0:
+            continue
+        ratio = median(new) / median(old)
+        # a lower throughput is the regression, not a longer one
+        slower = ratio < 1 / threshold if s == "bytes_per_s" else ratio > threshold
+        print(f"  {s:<15} {median(old):>10.2f} -> {median(new):>10.2f}  (x{ratio:.2f}){'  <- regression' if slower else ''}")
+
+
+if __name__ == "__main__":
+    from fire import Fire
+    Fire(summary)
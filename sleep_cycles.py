@@ -0,0 +1,161 @@
+"""
+personal sleep cycle length and time to fall asleep, estimated from the
+nights of the archive (see night_archive.py). SleepTk suggests wake up
+times and tells if a duration ends well within a cycle using _CYCLE_LENGTH
+minutes per cycle. The estimates replace it when pushed to the watch by
+pull_sleep_data.py --push_cycles, stored with wasp.system.set under
+CYCLES_SETTING as [cycle length, time to fall asleep] in minutes.
+
+The time to fall asleep of a night is the time until the first
+ONSET_MINUTES without any wake epoch according to sleep_staging. The cycle
+length is the lag between 60 and 130 minutes where the activity after
+falling asleep is the most correlated with itself, over all the nights.
+"""
+
+from pathlib import Path
+import numpy as np
+from fire import Fire
+
+from night_archive import NightArchive, ARCHIVE_NAME
+from sleep_staging import epoch_features, motion_hr
+
+CYCLES_SETTING = "sleeptk_cycles"
+
+# minutes of sleep without waking up needed to consider the night started
+ONSET_MINUTES = 10
+
+# range of the cycle lengths looked for, in minutes
+MIN_CYCLE = 60
+MAX_CYCLE = 130
+
+# nights shorter than this many hours are ignored
+MIN_HOURS = 4
+
+# below this autocorrelation, the nights are considered to show no cycle
+MIN_STRENGTH = 0.1
+
+
+def onset_latency(labels, timestamps, interval):
+    """minutes before the first ONSET_MINUTES of sleep, None if never
+    asleep. timestamps are the seconds since the start of each label"""
+    k = max(int(np.ceil(ONSET_MINUTES * 60 / interval)), 1)
+    asleep = np.convolve(labels != 0, np.ones(k, dtype=int), mode="valid") == k
+    if not asleep.any():
+        return None
+    return int(timestamps[asleep.argmax()]) / 60
+
+
+def autocorrelation(signals, max_lag):
+    """mean normalized autocorrelation of a list of 1D signals for the lags
+    0 to max_lag, each lag being averaged over all the pairs of epochs of
+    all the signals"""
+    length = max(len(s) for s in signals)
+    values = np.zeros((len(signals), length))
+    mask = np.zeros((len(signals), length))
+    for i, s in enumerate(signals):
+        values[i, :len(s)] = (s - s.mean()) / (s.std() or 1)
+        mask[i, :len(s)] = 1
+    n_fft = 2 ** int(np.ceil(np.log2(2 * length)))
+    products = np.fft.irfft(np.abs(np.fft.rfft(values, n=n_fft, axis=1)) ** 2, n=n_fft, axis=1)
+    pairs = np.fft.irfft(np.abs(np.fft.rfft(mask, n=n_fft, axis=1)) ** 2, n=n_fft, axis=1)
+    products = products[:, :max_lag + 1].sum(axis=0)
+    pairs = np.round(pairs[:, :max_lag + 1].sum(axis=0))
+    return np.divide(products, pairs, out=np.zeros(max_lag + 1), where=pairs > 0)
+
+
+def estimate_cycles(archive_dir, last=60, min_nights=7):
+    """
+    dict of the estimates over the last nights of the archive:
+        cycle_length: minutes, None if no lag stands out
+        latency: median minutes to fall asleep, None if unknown
+        strength: autocorrelation at cycle_length
+        nights: number of nights used
+    Only the nights with the most common saving interval are used.
+    """
+    archive = NightArchive(archive_dir)
+    index = archive.nights
+    if len(index) == 0:
+        return {"cycle_length": None, "latency": None, "strength": 0.0, "nights": 0}
+    intervals, counts = np.unique(index["interval"], return_counts=True)
+    interval = int(intervals[counts.argmax()])
+    nights = np.flatnonzero((index["interval"] == interval)
+                            & (index["length"] * interval >= MIN_HOURS * 3600))[-last:]
+    if len(nights) < min_nights:
+        return {"cycle_length": None, "latency": None, "strength": 0.0, "nights": len(nights)}
+
+    features = epoch_features(archive, nights)
+    labels = motion_hr(features)
+    bounds = np.cumsum(np.concatenate([[0], index["length"][nights]]))
+    latencies, signals = [], []
+    smooth = np.ones(3) / 3
+    for i, a, b in zip(nights, bounds[:-1], bounds[1:]):
+        timestamps = archive.night(i, ["Timestamp"])["Timestamp"]
+        latency = onset_latency(labels[a:b], timestamps, interval)
+        if latency is None:
+            continue
+        latencies.append(latency)
+        # activity on a regular grid of epochs, the delayed saves leaving
+        # gaps of zeros, so that lags are durations
+        epochs = timestamps // interval
+        onset = int(latency * 60) // interval
+        keep = epochs >= onset
+        signal = np.zeros(int(epochs[-1]) - onset + 1)
+        signal[epochs[keep] - onset] = features["activity"][a:b][keep]
+        signals.append(np.convolve(signal, smooth, mode="same"))
+
+    out = {"cycle_length": None,
+           "latency": float(np.median(latencies)) if latencies else None,
+           "strength": 0.0,
+           "nights": len(nights)}
+    min_lag = int(MIN_CYCLE * 60 / interval)
+    max_lag = int(MAX_CYCLE * 60 / interval)
+    signals = [s for s in signals if len(s) > max_lag]
+    if len(signals) >= min_nights:
+        acf = autocorrelation(signals, max_lag)
+        lag = min_lag + int(acf[min_lag:].argmax())
+        if acf[lag] > MIN_STRENGTH:
+            out["cycle_length"] = lag * interval / 60
+            out["strength"] = float(acf[lag])
+    return out
+
+
+def cycles_setting(estimates, default_cycle=90, default_latency=0):
+    """value stored on the watch under CYCLES_SETTING, the defaults being
+    used for what could not be estimated"""
+    cycle = estimates["cycle_length"] or default_cycle
+    latency = estimates["latency"] if estimates["latency"] is not None else default_latency
+    return [int(round(cycle)), int(round(latency))]
+
+
+def cycles(local_dir="remote_files/logs/sleep", archive_dir=None, last=60):
+    """
+    print the cycle length and time to fall asleep estimated from the
+    archive
+
+    Parameters
+    ----------
+    local_dir: str, default "remote_files/logs/sleep"
+        directory containing the logs and the archive
+    archive_dir: str, default None
+        location of the archive, None to use the 'archive' subdirectory of
+        local_dir
+    last: int, default 60
+        number of most recent nights used
+    """
+    archive_dir = Path(archive_dir or Path(local_dir) / ARCHIVE_NAME)
+    assert archive_dir.exists(), f"No archive at '{archive_dir}', run night_archive.py first"
+    est = estimate_cycles(archive_dir, last=last)
+    print(f"Nights used: {est['nights']}")
+    if est["cycle_length"] is None:
+        print("Cycle length: not enough data")
+    else:
+        print(f"Cycle length: {est['cycle_length']:.0f} min (autocorrelation {est['strength']:.2f})")
+    if est["latency"] is None:
+        print("Time to fall asleep: not enough data")
+    else:
+        print(f"Time to fall asleep: {est['latency']:.0f} min")
+    print(f"Value pushed to the watch: {cycles_setting(est)}")
+
+
+if __name__ == "__main__":
+    Fire(cycles)
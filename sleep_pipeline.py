@@ -0,0 +1,126 @@
+"""
+pull the watch and process the new nights in a single command: each night
+is parsed, cached, plotted and summarized by a pool of processes as soon as
+its transfer is verified, while the next files are still being pulled.
+Once the pull is over, the archive, the sleep stages, the statistics and
+the HTML report are updated, which only costs the new nights.
+
+Only the nights verified during this pull are processed, the older ones
+are left as they are, except for the statistics of the nights that failed
+or were missed by an interrupted run, computed at the end.
+"""
+
+import time
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from fire import Fire
+
+from watch_transport import WasptoolTransport
+from pull_sleep_data import download_sleep_data
+from plotter import _process_file, _init_worker
+from night_stats import NightStats, night_aggregates
+from sleep_staging import stage_archive
+from night_report import build_report
+
+
+def process_night(path, dpi=150):
+    """parse and cache, plot and compute the statistics of a night, returns
+    its aggregates (see night_stats.py) or None if the night was ignored"""
+    path = Path(path)
+    if _process_file(path, path.parent, "saveimg", True, dpi, None) is None:
+        return None
+    return night_aggregates(path)
+
+
+def pipeline(device,
+             local_dir="remote_files/logs/sleep",
+             workers=2,
+             dpi=150,
+             compress=False,
+             delete_after_dl=True,
+             push_cycles=False,
+             report=True,
+             transport=WasptoolTransport,
+             ):
+    """
+    pull the watch then process the new nights, see the docstring of the
+    module
+
+    Parameters
+    ----------
+    device: str
+        bluetooth ID of the watch
+    local_dir: str, default "remote_files/logs/sleep"
+        where the logs, plots, archive, statistics and report are stored
+    workers: int, default 2
+        number of processes handling the nights during the pull
+    dpi: int, default 150
+        resolution of the saved plots
+    compress, delete_after_dl, push_cycles, transport:
+        see pull_sleep_data.py
+    report: bool, default True
+        if True, update report.html, see night_report.py
+    """
+    assert isinstance(device, str) and "," not in device, "the pipeline handles a single watch"
+    assert workers >= 1, "Wrong 'workers' value"
+    futures = {}
+    last_verified = None
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+
+    def on_verified(path):
+        nonlocal last_verified
+        last_verified = time.perf_counter()
+        if path.suffix == ".csv":
+            futures[path] = executor.submit(process_night, path, dpi)
+
+    Path(local_dir).mkdir(parents=True, exist_ok=True)
+    stats = NightStats(local_dir)
+    processed = 0
+    try:
+        try:
+            download_sleep_data(local_dir=local_dir,
+                                device=device,
+                                compress=compress,
+                                delete_after_dl=delete_after_dl,
+                                notify=False,
+                                transport=transport,
+                                archive=True,
+                                push_cycles=push_cycles,
+                                on_verified=on_verified)
+        except SystemExit:
+            # nothing to pull, but the nights already verified are processed
+            pass
+
+        for path, future in futures.items():
+            try:
+                aggregates = future.result()
+            except Exception as err:
+                print(f"Error when processing '{path}': '{err}'")
+                continue
+            if aggregates is not None:
+                stats.add(path, aggregates)
+                processed += 1
+
+        # nights that failed above or during an interrupted run
+        try:
+            caught_up = stats.update()
+        except Exception as err:
+            print(f"Error when updating the statistics: '{err}'")
+        else:
+            if caught_up:
+                print(f"Computed the statistics of {caught_up} nights missed before.")
+    finally:
+        executor.shutdown()
+        stats.close()
+
+    if not futures:
+        print("No new nights to process.")
+        return
+    stage_archive(local_dir)
+    if report:
+        build_report(local_dir)
+    print(f"Processed {processed} new nights, done {time.perf_counter() - last_verified:.1f}s after the last transfer.")
+
+
+if __name__ == "__main__":
+    Fire(pipeline)
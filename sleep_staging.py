@@ -0,0 +1,219 @@
+"""
+offline sleep staging of the nights of the archive (see night_archive.py).
+Every epoch gets one of the labels of STAGE_LABELS, computed for all the
+nights at once with numpy. The labels are stored in the archive directory
+as stages_<algorithm>_v<STAGING_VERSION>.bin, one int8 per epoch in the
+order of the archive, and only the nights added since the last run are
+staged.
+
+Algorithms are functions registered in ALGORITHMS, taking the dict of
+arrays returned by epoch_features and returning one label per epoch.
+"""
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from fire import Fire
+
+from night_archive import NightArchive, ARCHIVE_NAME
+
+STAGE_LABELS = {
+        0: "wake",
+        1: "light",
+        2: "deep",
+        3: "rem",
+        }
+
+# to increase whenever the labels change, the archive is then staged again
+STAGING_VERSION = 2
+
+# change of the motion angle between two epochs, in radians, counting as an
+# activity of 1. It is the same for all the nights so that a restless night
+# gets more wake epochs than a still one
+ACTIVITY_SCALE = 0.1
+
+# weights of the Cole-Kripke algorithm for the epochs -4 to +2 around the
+# scored one
+_CK_WEIGHTS = np.array([106, 54, 58, 76, 230, 74, 67], dtype=float)
+
+
+def _night_convolve(values, night, weights, center):
+    """convolve values with weights without mixing epochs of different
+    nights: the nights are spread apart with zeros before convolving.
+    center is the position of the scored epoch in weights"""
+    pad = len(weights)
+    pos = np.arange(len(values)) + night * pad
+    spread = np.zeros(len(values) + (night[-1] + 1) * pad if len(values) else 0)
+    spread[pos] = values
+    # np.convolve flips the kernel, flipping it first keeps weights[0] on
+    # the oldest epoch
+    conv = np.convolve(spread, weights[::-1], mode="full")
+    return conv[pos + len(weights) - 1 - center]
+
+
+def epoch_features(archive, nights):
+    """
+    arrays describing every epoch of the given indices of nights:
+        night: index of the night of the epoch, starting at 0
+        activity: absolute difference of motion with the previous epoch,
+            divided by ACTIVITY_SCALE
+        bpm: heart rate linearly interpolated within each night, NaN for
+            nights without any
+        bpm_rel: heart rate divided by the median of its night
+    """
+    motion = np.concatenate([archive.night(i, ["Motion"])["Motion"] for i in nights]).astype(float)
+    bpm = np.concatenate([archive.night(i, ["BPM"])["BPM"] for i in nights]).astype(float)
+    return _features(motion, bpm, archive.nights["length"][nights])
+
+
+def _features(motion, bpm, lengths):
+    "see epoch_features, lengths being the number of epochs of each night"
+    night = np.repeat(np.arange(len(lengths)), lengths)
+
+    first = np.zeros(len(motion), dtype=bool)
+    first[np.cumsum(lengths)[:-1]] = True
+    if len(first):
+        first[0] = True
+    activity = np.abs(np.diff(motion, prepend=motion[:1])) / ACTIVITY_SCALE
+    activity[first] = 0
+
+    bpm = pd.Series(bpm).groupby(night).transform(
+            lambda b: b.interpolate(limit_direction="both")).to_numpy()
+    bpm_rel = bpm / pd.Series(bpm).groupby(night).transform("median").to_numpy()
+    return {"night": night, "activity": activity, "bpm": bpm, "bpm_rel": bpm_rel}
+
+
+def cole_kripke(features, threshold=0.5):
+    """wake if the weighted activity around the epoch is above threshold,
+    light sleep otherwise. The weights are the ones of Cole-Kripke but
+    applied to the activity of SleepTk's epochs, see ACTIVITY_SCALE"""
+    score = _night_convolve(features["activity"], features["night"], _CK_WEIGHTS / _CK_WEIGHTS.sum(), center=4)
+    return np.where(score > threshold, 0, 1).astype(np.int8)
+
+
+def motion_hr(features, threshold=0.5, deep_activity=0.1):
+    """
+    wake epochs are found like cole_kripke, the sleep epochs are then split
+    using the heart rate relative to the median of the night:
+        deep: very low activity and heart rate below the median
+        rem: low activity and heart rate 5% above the median
+        light: the rest
+    Nights without heart rate only get wake and light.
+    """
+    labels = cole_kripke(features, threshold)
+    score = _night_convolve(features["activity"], features["night"], np.ones(5) / 5, center=2)
+    bpm_rel = features["bpm_rel"]
+    has_hr = ~np.isnan(bpm_rel)
+    asleep = labels == 1
+    labels[asleep & has_hr & (score < deep_activity) & (bpm_rel < 1.0)] = 2
+    labels[asleep & has_hr & (score < threshold) & (bpm_rel > 1.05)] = 3
+    return labels
+
+
+ALGORITHMS = {
+        "cole_kripke": cole_kripke,
+        "motion_hr": motion_hr,
+        }
+
+
+def stage_nights(archive_dir, nights, algorithm="motion_hr"):
+    "labels of all the epochs of the given indices of nights"
+    assert algorithm in ALGORITHMS, f"Unknown algorithm '{algorithm}'"
+    archive = NightArchive(archive_dir)
+    if len(nights) == 0:
+        return np.zeros(0, dtype=np.int8)
+    return ALGORITHMS[algorithm](epoch_features(archive, nights))
+
+
+def stage_night(df, algorithm="motion_hr"):
+    "labels of the epochs of a night loaded by night_loader.load_night"
+    assert algorithm in ALGORITHMS, f"Unknown algorithm '{algorithm}'"
+    if len(df) == 0:
+        return np.zeros(0, dtype=np.int8)
+    features = _features(df["Motion"].to_numpy(dtype=float),
+                         df["BPM"].to_numpy(dtype=float),
+                         np.array([len(df)]))
+    return ALGORITHMS[algorithm](features)
+
+
+def _stages_path(archive_dir, algorithm):
+    "file storing the labels of the archive"
+    return Path(archive_dir) / f"stages_{algorithm}_v{STAGING_VERSION}.bin"
+
+
+def load_stages(archive_dir, algorithm="motion_hr"):
+    """labels of the staged epochs of the archive, as a memmap in the order
+    of the epochs of the archive"""
+    path = _stages_path(archive_dir, algorithm)
+    if not path.exists() or path.stat().st_size == 0:
+        return np.zeros(0, dtype=np.int8)
+    return np.memmap(path, dtype=np.int8, mode="r")
+
+
+def stage_archive(local_dir="remote_files/logs/sleep",
+                  archive_dir=None,
+                  algorithm="motion_hr",
+                  workers=1,
+                  batch_size=64,
+                  redo=False,
+                  ):
+    """
+    stage the nights of the archive that were not staged yet
+
+    Parameters
+    ----------
+    local_dir: str, default "remote_files/logs/sleep"
+        directory containing the logs and the archive
+    archive_dir: str, default None
+        location of the archive, None to use the 'archive' subdirectory of
+        local_dir
+    algorithm: str, default "motion_hr"
+        key of ALGORITHMS
+    workers: int, default 1
+        number of processes staging batches of nights in parallel
+    batch_size: int, default 64
+        number of nights given at once to each process
+    redo: bool, default False
+        if True, the whole archive is staged again
+    """
+    assert algorithm in ALGORITHMS, f"Unknown algorithm '{algorithm}'"
+    assert workers >= 1, "Wrong 'workers' value"
+    archive_dir = Path(archive_dir or Path(local_dir) / ARCHIVE_NAME)
+    archive = NightArchive(archive_dir)
+    path = _stages_path(archive_dir, algorithm)
+    if redo and path.exists():
+        path.unlink()
+
+    # nights are staged in whole, the file is truncated to the end of the
+    # last night that was fully staged
+    done = len(load_stages(archive_dir, algorithm))
+    ends = archive.nights["offset"] + archive.nights["length"]
+    n_done = int(np.searchsorted(ends, done, side="right"))
+    done = int(ends[n_done - 1]) if n_done else 0
+    todo = np.arange(n_done, len(archive))
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+
+    with open(path, "ab") as f:
+        f.truncate(done)
+        if workers == 1:
+            results = (stage_nights(archive_dir, b, algorithm) for b in batches)
+            for labels in results:
+                f.write(labels.tobytes())
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for labels in executor.map(stage_nights,
+                                           [archive_dir] * len(batches),
+                                           batches,
+                                           [algorithm] * len(batches)):
+                    f.write(labels.tobytes())
+
+    stages = load_stages(archive_dir, algorithm)
+    counts = np.bincount(stages, minlength=len(STAGE_LABELS)) if len(stages) else np.zeros(len(STAGE_LABELS), dtype=int)
+    print(f"Staged {len(todo)} new nights with '{algorithm}', {len(stages)} epochs in total:")
+    for value, label in STAGE_LABELS.items():
+        print(f"  {label:<6} {counts[value] / max(len(stages), 1):>6.1%}")
+
+
+if __name__ == "__main__":
+    Fire(stage_archive)
@@ -34,6 +34,7 @@ import shell
 import fonts
 import math
 import ppg
+import struct
 from array import array
 from micropython import const
 import random
@@ -82,6 +83,11 @@ _FREQ = const(2)
 # every _STORE_FREQ seconds (default: 2)
 _HR_FREQ = const(300)
 # how many seconds between heart rate data (default: 300, minimum 120)
+_RAW_PPG = const(0)
+# set to 1 to store the raw heart rate sensor readings in a .ppg file next
+# to the .csv instead of computing the heart rate on the watch, which saves
+# battery. The heart rate is then computed on the computer by
+# ppg_analysis.py. Uses about 1KB of flash per reading. (default: 0)
 _STORE_FREQ = const(120)
 # process data and store to file every X seconds (recomended: 120)
 _BATTERY_THRESHOLD = const(20)
@@ -101,13 +107,16 @@ _CYCLE_LENGTH = const(90)
 _SLEEP_GOAL_CYCLE = const(5)
 # number of sleep cycle you wish to sleep. With _CYCLE_LENGTH this is used
 # to suggest best wake up time to user when setting the alarm. (default: 5)
+# Note: _CYCLE_LENGTH is replaced by the cycle length and time to fall
+# asleep estimated from your past nights if they were sent to the watch
+# with pull_sleep_data.py --push_cycles
 ##################################################
 
 
 class SleepTkApp():
     NAME = 'SleepTk'
     ICON = icon
-    VERSION = const(1)
+    VERSION = const(2)
 
     def __init__(self):
         # simple flag to init the variables only when the app is launched and
@@ -138,6 +147,17 @@ class SleepTkApp():
             except Exception:
                 pass
 
+        # personal cycle length and time to fall asleep in minutes, estimated
+        # by the computer from the past nights (see sleep_cycles.py)
+        self._cycle_length = _CYCLE_LENGTH
+        self._sleep_latency = _OFF
+        if hasattr(wasp.system, "get") and callable(wasp.system.get):
+            try:
+                self._cycle_length, self._sleep_latency = [
+                        int(v) for v in wasp.system.get("sleeptk_cycles")]
+            except Exception:
+                pass
+
         self._state_spinval_H = _OFF
         self._state_spinval_M = _OFF
         self._hrdata = None
@@ -392,7 +412,7 @@ class SleepTkApp():
             int(duration // 60),
             int(duration % 60),
             percent_str), 0, y)
-        cycl = duration / _CYCLE_LENGTH
+        cycl = max(duration - self._sleep_latency, 0) / self._cycle_length
         cycl_modulo = cycl % 1
         draw.string("so {} cycles   ".format(str(cycl)[0:4]), 0, y + 20)
         if duration > 30 and not self._track_HR_once:
@@ -458,8 +478,9 @@ class SleepTkApp():
                 if (self._state_spinval_H, self._state_spinval_M) == (_OFF, _OFF):
                     # suggest wake up time, on the basis of desired sleep goal + time to fall asleep
                     (H, M) = wasp.watch.rtc.get_localtime()[3:5]
-                    goal_h = _SLEEP_GOAL_CYCLE * _CYCLE_LENGTH // 60
-                    goal_m = _SLEEP_GOAL_CYCLE * _CYCLE_LENGTH % 60
+                    goal = _SLEEP_GOAL_CYCLE * self._cycle_length + self._sleep_latency
+                    goal_h = goal // 60
+                    goal_m = goal % 60
                     M += goal_m
                     while M % 5 != 0:
                         M += 1
@@ -523,8 +544,9 @@ class SleepTkApp():
             (xyz[0], xyz[1], xyz[2]))  # contains previous accelerometer value
             # create one file per recording session:
             self.filep = "logs/sleep/{}_{}_{}.csv".format(str(self._track_start_time + _TIMESTAMP), _STORE_FREQ, self.VERSION)
+            self.ppgp = self.filep[:-4] + ".ppg"
             with open(self.filep, "wb") as f:
-                f.write("Timestamp,Motion,BPM,Meta".encode("ascii"))
+                f.write("Timestamp,Motion,BPM,Meta,Check".encode("ascii"))
             self.next_track_time = wasp.watch.rtc.time() + _FREQ
             wasp.system.set_alarm(self.next_track_time, self._trackOnce)
         else:
@@ -667,6 +689,9 @@ class SleepTkApp():
                      1 if pressed or touched (indicating wake state)
                      2 if gradual vibration happened or natural wake
                      3 if pressed or touched after gradual vibration
+            7. check: sum of the bytes of the row before it modulo 256,
+                written with 3 digits, so that a row cut short by a reset
+                during the write can be told apart from a complete one
         """
         # fix the status bar never updating
         self.stat_bar = widgets.StatusBar()
@@ -682,6 +707,8 @@ class SleepTkApp():
             # heart rate after 60s, something went wrong and saving motion
             # data is more important so cancelling this tracking
             self._track_HR_once = _OFF
+            # the next reading starts from an empty window
+            self._hrdata = None
         if n >= _STORE_FREQ // _FREQ and not self._track_HR_once:
             if self._last_HR != _OFF:
                 bpm = self._last_HR
@@ -706,13 +733,17 @@ class SleepTkApp():
                 timestamp = ""
             else:
                 self._latest_save = timestamp
-            with open(self.filep, "ab") as f:
-                f.write("\n{},{:.3f},{},{}".format(
+            row = "{},{:.3f},{},{}".format(
                     timestamp,
                     motion,
                     bpm,
                     meta,
-                    ).encode("ascii"))
+                    ).encode("ascii")
+            check = 0
+            for c in row:
+                check += c
+            with open(self.filep, "ab") as f:
+                f.write(b"\n" + row + ",{:03d}".format(check % 256).encode("ascii"))
             # reset buffer
             buff = array("f", (_OFF, _OFF, _OFF))
             wasp.watch.accel.reset()
@@ -793,7 +824,12 @@ class SleepTkApp():
         elif self._track_HR_once:
             wasp.watch.hrs.enable()
             if self._hrdata is None:
-                self._hrdata = ppg.PPG(wasp.watch.hrs.read_hrs())
+                if _RAW_PPG:
+                    # the readings of the sensor take 18 bits
+                    self._hrdata = array("I", bytes(960))
+                    self._hr_n = 0
+                else:
+                    self._hrdata = ppg.PPG(wasp.watch.hrs.read_hrs())
             t = wasp.machine.Timer(id=1, period=8000000)
             t.start()
             wasp.system.keep_awake()
@@ -814,7 +850,17 @@ class SleepTkApp():
             del t
 
             wasp.system.keep_awake()
-            if len(self._hrdata.data) >= 240:  # 10 seconds passed
+            if _RAW_PPG:
+                if self._hr_n >= 240:  # 10 seconds passed
+                    self._save_raw_ppg()
+                    self._last_HR_printed = "raw"
+                    self._last_HR_date = int(wasp.watch.rtc.time())
+                    self._track_HR_once = _OFF
+                    self._hrdata = None
+                    wasp.watch.hrs.disable()
+                    if abs(int(wasp.watch.rtc.time()) - self._last_touch) > 10:
+                        wasp.system.sleep()
+            elif len(self._hrdata.data) >= 240:  # 10 seconds passed
                 bpm = self._hrdata.get_heart_rate()
                 bpm = int(bpm) if bpm is not None else None
                 if bpm is None:
@@ -840,7 +886,23 @@ class SleepTkApp():
 
     def _subtick(self):
         """track heart rate at 24Hz"""
-        self._hrdata.preprocess(wasp.watch.hrs.read_hrs())
+        if _RAW_PPG:
+            if self._hr_n < 240:
+                self._hrdata[self._hr_n] = wasp.watch.hrs.read_hrs()
+                self._hr_n += 1
+        else:
+            self._hrdata.preprocess(wasp.watch.hrs.read_hrs())
+
+    def _save_raw_ppg(self):
+        """append the raw heart rate readings to the .ppg file, each record
+        being the number of seconds between the start of the tracking and
+        the start of the reading (uint32), the number of samples (uint16)
+        then the samples (uint32), all little endian"""
+        with open(self.ppgp, "ab") as f:
+            f.write(struct.pack("<IH",
+                                self._track_HR_once - self._track_start_time,
+                                self._hr_n))
+            f.write(self._hrdata)
 
     def _tiny_vibration(self):
         """vibrate just a tiny bit before waking up, to gradually return
@@ -0,0 +1,421 @@
+"""
+replays nights through the unmodified SleepTkApp of sleep_tk.py on the
+computer: wasp, widgets, shell, fonts, ppg, ble and micropython are replaced
+by stubs driven by a virtual clock, so a whole night of accelerometer
+samples, heart rate measurements, alarms, gradual wake vibrations and
+snoozes runs in a fraction of a second. Useful to check changes to the
+tracking or to the alarms on many nights without wearing the watch.
+
+The accelerometer and the heart rate come from functions of the number of
+seconds elapsed since the start of the tracking, either synthetic ones or
+built from recordings.
+"""
+
+import sys
+import time
+import math
+import heapq
+import random
+import calendar
+import builtins
+import importlib.util
+from pathlib import Path
+from types import ModuleType, SimpleNamespace
+from fire import Fire
+
+SLEEP_TK_PATH = Path(__file__).parent / "sleep_tk.py"
+
+# seconds between 1970 and 2000, the epoch of wasp-os
+_WASP_EPOCH = 946684800
+
+# seconds without keep_awake after which the watch goes back to sleep
+_SLEEP_TIMEOUT = 15
+
+
+class VirtualClock:
+    "time of the simulated watch, in seconds since the wasp-os epoch"
+    def __init__(self, now):
+        self.now = float(now)
+
+    def localtime(self, t=None):
+        "like time.localtime of micropython, the watch being set to UTC"
+        return time.gmtime(int(self.now if t is None else t) + _WASP_EPOCH)[:8]
+
+    def mktime(self, tup):
+        return calendar.timegm(tuple(tup[:6]) + (0, 0, 0)) - _WASP_EPOCH
+
+
+class _Widget:
+    "stand-in for every widget of wasp-os, remembers its state and value"
+    def __init__(self, *args, **kwargs):
+        self.state = 0
+        self.value = kwargs.get("value", args[2] if len(args) > 2 else 0)
+        self.clock = False
+
+    def draw(self, *args, **kwargs):
+        pass
+
+    def update(self, *args, **kwargs):
+        pass
+
+    def touch(self, event):
+        return False
+
+
+class _PPG:
+    """stand-in for ppg.PPG: stores the samples and returns the heart rate
+    given by the replay once enough of them were collected"""
+    def __init__(self, spl, heart_rate=None):
+        self.data = []
+        self._heart_rate = heart_rate
+
+    def preprocess(self, spl):
+        self.data.append(spl)
+
+    def get_heart_rate(self):
+        return self._heart_rate()
+
+
+class _Timer:
+    "wasp.machine.Timer, instantly reports the whole period as elapsed"
+    def __init__(self, id=0, period=0):
+        self.period = period
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def time(self):
+        return self.period
+
+
+class SimulatedWatch:
+    """
+    stubs of the modules imported by sleep_tk.py, sharing a virtual clock.
+
+    Parameters
+    ----------
+    root: str
+        directory acting as the flash of the watch, the logs end up in
+        root/logs/sleep
+    start: int
+        unix time of the start of the replay
+    accel: callable
+        called with the elapsed seconds, returns the (x, y, z) of the
+        accelerometer
+    heart_rate: callable
+        called with the elapsed seconds when the app asks for the heart
+        rate, returns the BPM or None if it could not be computed
+    battery: callable, default None
+        called with the elapsed seconds, returns the battery level. None for
+        a constant 80%
+    settings: list, default None
+        value returned by wasp.system.get("sleeptk_settings")
+    """
+    def __init__(self, root, start, accel, heart_rate, battery=None, settings=None):
+        self.root = Path(root)
+        self.clock = VirtualClock(start - _WASP_EPOCH)
+        self.start = self.clock.now
+        self.accel = accel
+        self.heart_rate = heart_rate
+        self.battery = battery or (lambda elapsed: 80)
+        self.alarms = []  # heap of (time, order, action)
+        self._order = 0
+        self.tick_period = None  # in ms, None when no tick is requested
+        self.awake = True
+        self.sleep_at = self.clock.now + _SLEEP_TIMEOUT
+        self.vibrations = []  # (elapsed seconds, duty, ms)
+        self.notifications = []
+        self.settings = {"sleeptk_settings": settings} if settings is not None else {}
+        self.modules = self._make_modules()
+
+    def elapsed(self):
+        return self.clock.now - self.start
+
+    # wasp.system ###########################################################
+    def set_alarm(self, when, action):
+        heapq.heappush(self.alarms, (when, self._order, action))
+        self._order += 1
+
+    def cancel_alarm(self, when, action):
+        self.alarms = [a for a in self.alarms
+                       if not (a[2] == action and (when is None or a[0] == when))]
+        heapq.heapify(self.alarms)
+
+    def request_tick(self, period_ms=None):
+        self.tick_period = period_ms
+
+    def sleep(self):
+        # the ticks of the app stop while the watch sleeps
+        self.awake = False
+        self.tick_period = None
+
+    def wake(self):
+        self.awake = True
+        self.keep_awake()
+
+    def keep_awake(self):
+        self.sleep_at = self.clock.now + _SLEEP_TIMEOUT
+
+    def _make_modules(self):
+        clock = self.clock
+        sim = self
+
+        system = SimpleNamespace(
+                set_alarm=self.set_alarm,
+                cancel_alarm=self.cancel_alarm,
+                request_tick=self.request_tick,
+                request_event=lambda mask: None,
+                sleep=self.sleep,
+                wake=self.wake,
+                switch=lambda app: None,
+                keep_awake=self.keep_awake,
+                navigate=lambda event: None,
+                notify=lambda ms, msg: sim.notifications.append((sim.elapsed(), msg)),
+                notify_level=2,
+                brightness=2,
+                get=lambda key: sim.settings[key],
+                set=lambda key, value: sim.settings.__setitem__(key, value),
+                )
+        drawable = SimpleNamespace(**{name: (lambda *args, **kwargs: None)
+                                      for name in ["set_font", "set_color", "string", "fill", "reset"]})
+        watch = SimpleNamespace(
+                rtc=SimpleNamespace(
+                    time=lambda: clock.now,
+                    get_localtime=lambda: clock.localtime(),
+                    get_uptime_ms=lambda: int((clock.now - sim.start) * 1000),
+                    ),
+                time=SimpleNamespace(localtime=clock.localtime, mktime=clock.mktime),
+                accel=SimpleNamespace(
+                    accel_xyz=lambda: tuple(sim.accel(sim.elapsed())),
+                    reset=lambda: None,
+                    ),
+                battery=SimpleNamespace(level=lambda: sim.battery(sim.elapsed())),
+                hrs=SimpleNamespace(enable=lambda: None,
+                                    disable=lambda: None,
+                                    read_hrs=lambda: 0),
+                display=SimpleNamespace(mute=lambda state: None,
+                                        poweron=lambda: None,
+                                        poweroff=lambda: None),
+                backlight=SimpleNamespace(set=lambda level: None),
+                vibrator=SimpleNamespace(
+                    pulse=lambda duty=50, ms=40: sim.vibrations.append((sim.elapsed(), duty, ms))),
+                drawable=drawable,
+                )
+
+        wasp = ModuleType("wasp")
+        wasp.system = system
+        wasp.watch = watch
+        wasp.gc = SimpleNamespace(collect=lambda: None)
+        wasp.machine = SimpleNamespace(Timer=_Timer)
+        wasp.EventMask = SimpleNamespace(TOUCH=1, SWIPE_LEFTRIGHT=2, SWIPE_UPDOWN=4, BUTTON=8)
+        wasp.EventType = SimpleNamespace(LEFT=1, RIGHT=2, UP=3, DOWN=4, HOME=5)
+
+        widgets = ModuleType("widgets")
+        for name in ["StatusBar", "Button", "Checkbox", "Spinner", "ConfirmationView"]:
+            setattr(widgets, name, _Widget)
+
+        shell = ModuleType("shell")
+        shell.mkdir = lambda path: (self.root / path).mkdir(parents=True, exist_ok=False)
+
+        fonts = ModuleType("fonts")
+        fonts.sans18 = None
+
+        ppg = ModuleType("ppg")
+        ppg.PPG = lambda spl: _PPG(spl, lambda: sim.heart_rate(sim.elapsed()))
+
+        micropython = ModuleType("micropython")
+        micropython.const = lambda value: value
+
+        ble = ModuleType("ble")
+        ble.enabled = lambda: True
+        ble.disable = lambda: None
+
+        return {"wasp": wasp, "widgets": widgets, "shell": shell, "fonts": fonts,
+                "ppg": ppg, "micropython": micropython, "ble": ble}
+
+    def load_app_module(self, path=SLEEP_TK_PATH):
+        """import a fresh copy of sleep_tk.py bound to these stubs, its
+        files being opened relative to root"""
+        saved = {name: sys.modules.get(name) for name in self.modules}
+        sys.modules.update(self.modules)
+        try:
+            spec = importlib.util.spec_from_file_location("sleep_tk_replayed", path)
+            module = importlib.util.module_from_spec(spec)
+            root = self.root
+            module.open = lambda file, mode="r": builtins.open(root / file, mode)
+            spec.loader.exec_module(module)
+        finally:
+            for name, mod in saved.items():
+                if mod is None:
+                    del sys.modules[name]
+                else:
+                    sys.modules[name] = mod
+        return module
+
+    def run(self, app, until, events=()):
+        """
+        advance the virtual clock until the elapsed seconds reach until,
+        firing the alarms, the ticks of the app and the user events, given
+        as (elapsed seconds, method name, argument) like (3600, "press",
+        (0, True))
+        """
+        events = sorted(events, key=lambda e: e[0])
+        next_tick = None
+        end = self.start + until
+        while True:
+            candidates = []
+            if self.alarms:
+                candidates.append(self.alarms[0][0])
+            if self.tick_period is not None:
+                if next_tick is None or next_tick < self.clock.now:
+                    next_tick = self.clock.now + self.tick_period / 1000
+                candidates.append(next_tick)
+            else:
+                next_tick = None
+            if events:
+                candidates.append(self.start + events[0][0])
+            if not candidates or min(candidates) > end:
+                break
+            t = min(candidates)
+            self.clock.now = max(self.clock.now, t)
+            if events and self.start + events[0][0] == t:
+                _, method, arg = events.pop(0)
+                getattr(app, method)(*arg)
+            elif self.alarms and self.alarms[0][0] == t:
+                _, _, action = heapq.heappop(self.alarms)
+                action()
+            elif self.clock.now > self.sleep_at:
+                # nothing kept the watch awake
+                self.sleep()
+            else:
+                next_tick = t + self.tick_period / 1000
+                app.tick(1)
+        self.clock.now = max(self.clock.now, end)
+
+
+def synthetic_accel(seed=0):
+    """accelerometer of a sleeper: the wrist lies still, with a movement
+    every few minutes and restless periods every 90 minutes"""
+    rng = random.Random(seed)
+    position = [0.0, 0.0, 1000.0]
+
+    def accel(elapsed):
+        restless = math.sin(2 * math.pi * elapsed / 5400) > 0.8
+        if rng.random() < (0.05 if restless else 0.005):
+            position[0] = rng.uniform(-1000, 1000)
+            position[1] = rng.uniform(-1000, 1000)
+        return tuple(int(p + rng.gauss(0, 5)) for p in position)
+    return accel
+
+
+def synthetic_heart_rate(seed=0, failure_rate=0.1):
+    "heart rate slowly going down during the night, sometimes not computable"
+    rng = random.Random(seed)
+
+    def heart_rate(elapsed):
+        if rng.random() < failure_rate:
+            return None
+        return 65 - 10 * min(elapsed / 14400, 1) + rng.gauss(0, 3)
+    return heart_rate
+
+
+def replay_night(root,
+                 start=1700000000,
+                 hours=8,
+                 alarm=None,
+                 gradual_wake=True,
+                 natural_wake=False,
+                 heart_rate_tracking=True,
+                 accel=None,
+                 heart_rate=None,
+                 battery=None,
+                 events=(),
+                 seed=0,
+                 ):
+    """
+    replay one night of SleepTkApp from the start of the tracking, returns
+    the SimulatedWatch (with its vibrations and notifications) and the app
+
+    Parameters
+    ----------
+    root: str
+        directory acting as the flash of the watch
+    start: int, default 1700000000
+        unix time at which the tracking starts
+    hours: float, default 8
+        duration of the replay
+    alarm: tuple, default None
+        (hour, minute) of the alarm, in UTC. None to disable the alarm.
+    gradual_wake, natural_wake, heart_rate_tracking: bool
+        settings of the app
+    accel, heart_rate, battery: callable, default None
+        see SimulatedWatch, None to use synthetic ones
+    events: list, default ()
+        user interactions, see SimulatedWatch.run
+    """
+    watch = SimulatedWatch(root,
+                           start,
+                           accel or synthetic_accel(seed),
+                           heart_rate or synthetic_heart_rate(seed),
+                           battery)
+    sleep_tk = watch.load_app_module()
+    app = sleep_tk.SleepTkApp()
+    app.foreground()
+    app._state_alarm = int(alarm is not None)
+    app._state_gradual_wake = int(gradual_wake)
+    app._state_natwake = int(natural_wake)
+    app._state_body_tracking = 1
+    app._state_HR_tracking = int(heart_rate_tracking)
+    if alarm is not None:
+        app._state_spinval_H, app._state_spinval_M = alarm
+    app._start_tracking()
+    # the watch goes to sleep once the tracking started
+    watch.sleep()
+    watch.run(app, hours * 3600, events)
+    return watch, app
+
+
+def replay(n_nights=1,
+           hours=8,
+           alarm=None,
+           out_dir="replay",
+           seed=0,
+           ):
+    """
+    replay synthetic nights and print how long it took
+
+    Parameters
+    ----------
+    n_nights: int, default 1
+        number of nights to replay
+    hours: float, default 8
+        duration of each night
+    alarm: str, default None
+        time of the alarm as HH:MM in UTC, None to disable the alarm
+    out_dir: str, default "replay"
+        the logs are written in out_dir/logs/sleep
+    seed: int, default 0
+        seed of the first night
+    """
+    if alarm is not None:
+        alarm = tuple(int(x) for x in str(alarm).split(":"))
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    begin = time.perf_counter()
+    for night in range(n_nights):
+        # tracking starts at 23:00 UTC
+        start = 1700002800 + 86400 * night
+        watch, app = replay_night(out_dir,
+                                  start=start,
+                                  hours=hours,
+                                  alarm=alarm,
+                                  seed=seed + night)
+        print(f"Night {night}: '{app.filep}', {len(watch.vibrations)} vibrations, {len(watch.notifications)} notifications")
+    duration = time.perf_counter() - begin
+    print(f"Replayed {n_nights} nights of {hours}h in {duration:.2f}s ({duration / n_nights * 1000:.0f}ms per night)")
+
+
+if __name__ == "__main__":
+    Fire(replay)
@@ -0,0 +1,187 @@
+"""
+generator of fake sleep logs looking like the ones written by SleepTk, with
+the quirks the host tools have to handle: elided timestamps, delayed saves,
+missing and invalid heart rates, meta values and logs too short to be kept.
+Used by the benchmarks to test the tools on any number of nights.
+"""
+
+import random
+from pathlib import Path
+from fire import Fire
+
+HEADER = "Timestamp,Motion,BPM,Meta"
+
+
+def _format_v1(timestamp, motion, bpm, meta):
+    "one row of a version 1 log"
+    return f"{timestamp},{motion:.3f},{bpm},{meta}"
+
+
+def _format_v2(timestamp, motion, bpm, meta):
+    "one row of a version 2 log, ending with its check like the watch does"
+    row = _format_v1(timestamp, motion, bpm, meta)
+    return f"{row},{sum(row.encode('ascii')) % 256:03d}"
+
+
+# header and function formatting a row for each version of the log format
+ROW_FORMATS = {
+        1: (HEADER, _format_v1),
+        2: (HEADER + ",Check", _format_v2),
+        }
+
+
+def night_rows(n_rows, rng, hr_density=1/3, invalid_hr_rate=0.2, gap_rate=0.02, meta_rate=0.02,
+               cycle_length=None, latency=0, interval=120):
+    """
+    yields the values (timestamp, motion, bpm, meta) of the rows of a night,
+    written like the watch does: the timestamp is empty when it follows the
+    previous one, bpm and meta are empty when there is nothing to write.
+
+    Parameters
+    ----------
+    n_rows: int
+        number of rows
+    rng: random.Random
+    hr_density: float, default 1/3
+        fraction of rows with a heart rate measurement
+    invalid_hr_rate: float, default 0.2
+        fraction of the measurements that failed and are written as "?"
+    gap_rate: float, default 0.02
+        probability of each save to be delayed, skipping a few epochs
+    meta_rate: float, default 0.02
+        fraction of rows with a touch or vibration
+    cycle_length: float, default None
+        if set, minutes between the ends of two sleep cycles, where the
+        sleeper moves more
+    latency: float, default 0
+        minutes of restless wake before falling asleep
+    interval: int, default 120
+        seconds between two epochs, used by cycle_length and latency
+    """
+    motion = 0.5
+    latest = -1
+    epoch = 1  # the first save happens after one interval
+    for _ in range(n_rows):
+        if rng.random() < gap_rate:
+            epoch += rng.randint(1, 5)
+        minutes = (epoch * interval) / 60
+        scale = 1
+        if minutes < latency:
+            scale = 4
+        elif cycle_length:
+            # movements at the end of each cycle, in light sleep
+            scale = 3 if (minutes - latency) % cycle_length > 0.85 * cycle_length else 0.5
+        motion = min(max(motion + rng.gauss(0, 0.05 * scale), -1.5), 1.5)
+        timestamp = "" if epoch == latest + 1 else epoch
+        latest = epoch
+        epoch += 1
+        if rng.random() < hr_density:
+            bpm = "?" if rng.random() < invalid_hr_rate else rng.randint(45, 75)
+        else:
+            bpm = ""
+        meta = rng.choice([1, 2, 3]) if rng.random() < meta_rate else ""
+        yield timestamp, motion, bpm, meta
+
+
+def generate_night(directory,
+                   start,
+                   n_rows,
+                   interval=120,
+                   version=1,
+                   seed=0,
+                   torn=False,
+                   **kwargs,
+                   ):
+    """write a log of n_rows rows named like SleepTk does in directory,
+    returns its path. If torn is True the last row is cut short like when
+    the watch resets during a save. kwargs are given to night_rows"""
+    assert version in ROW_FORMATS, f"Unknown log version {version}"
+    header, fmt = ROW_FORMATS[version]
+    rng = random.Random(seed)
+    lines = [header]
+    lines.extend(fmt(*row) for row in night_rows(n_rows, rng, interval=interval, **kwargs))
+    if torn and len(lines) > 1:
+        lines[-1] = lines[-1][:rng.randint(0, len(lines[-1]) - 1)]
+    path = Path(directory) / f"{start}_{interval}_{version}.csv"
+    path.write_text("\n".join(lines))
+    return path
+
+
+def generate_nights(directory,
+                    n_nights=30,
+                    hours=8,
+                    interval=120,
+                    version=1,
+                    hr_density=1/3,
+                    invalid_hr_rate=0.2,
+                    gap_rate=0.02,
+                    meta_rate=0.02,
+                    short_rate=0.0,
+                    torn_rate=0.0,
+                    cycle_length=None,
+                    latency=0,
+                    first_start=1700000000,
+                    seed=0,
+                    ):
+    """
+    write n_nights logs in directory, one per day
+
+    Parameters
+    ----------
+    directory: str
+        where to write the logs, created if needed
+    n_nights: int, default 30
+        number of nights
+    hours: float, default 8
+        duration of each night
+    interval: int, default 120
+        seconds between two rows, the F of the filename
+    version: int, default 1
+        format of the logs, the V of the filename
+    hr_density, invalid_hr_rate, gap_rate, meta_rate: float
+        see night_rows
+    short_rate: float, default 0.0
+        fraction of the nights with 0 to 5 rows only, like when the tracking
+        is started by mistake
+    torn_rate: float, default 0.0
+        fraction of the nights whose last row is cut short
+    cycle_length, latency: float
+        see night_rows
+    first_start: int, default 1700000000
+        the first night starts one day after this unix time
+    seed: int, default 0
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    for night in range(n_nights):
+        start = first_start + 86400 * (night + 1)
+        if rng.random() < short_rate:
+            n_rows = rng.randint(0, 5)
+        else:
+            n_rows = int(hours * 3600 // interval)
+        paths.append(generate_night(directory,
+                                    start,
+                                    n_rows,
+                                    interval=interval,
+                                    version=version,
+                                    seed=rng.random(),
+                                    torn=rng.random() < torn_rate,
+                                    hr_density=hr_density,
+                                    invalid_hr_rate=invalid_hr_rate,
+                                    gap_rate=gap_rate,
+                                    meta_rate=meta_rate,
+                                    cycle_length=cycle_length,
+                                    latency=latency))
+    return paths
+
+
+def generate(directory, **kwargs):
+    "command line version of generate_nights"
+    paths = generate_nights(directory, **kwargs)
+    print(f"Wrote {len(paths)} nights to '{directory}'")
+
+
+if __name__ == "__main__":
+    Fire(generate)
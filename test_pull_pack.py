@@ -0,0 +1,58 @@
+"""
+round trip of the 4 bit packing of the sleep logs: the code packing them is
+run on FakeWatchTransport and the chunks it prints are decoded by _unpack
+"""
+
+import base64
+
+from watch_transport import FakeWatchTransport
+from pull_sleep_data import _READ_CODE, _PACK_TABLE, _unpack
+
+
+def _read_packed(tmp_path, content, max_chunk=64):
+    "bytes of content sent by the fake watch as packed chunks, then unpacked"
+    (tmp_path / "night.csv").write_bytes(content)
+    transport = FakeWatchTransport(tmp_path, latency=0)
+    out = transport.exec(_READ_CODE.format(remote_dir=transport.remote_dir,
+                                           name="night.csv",
+                                           offset=0,
+                                           stop=len(content),
+                                           max_chunk=max_chunk,
+                                           pack=True,
+                                           table=repr(_PACK_TABLE)[2:-1]))
+    received = b""
+    chunks = 0
+    for line in out.splitlines():
+        if line.startswith("SLEEPTK_PACKED "):
+            _, offset, size, data = line.split(" ", 3)
+            assert int(offset) == len(received)
+            received += _unpack(base64.b64decode(data), int(size))
+            chunks += 1
+    assert f"SLEEPTK_DONE {len(content)}" in out.splitlines()
+    return received, chunks
+
+
+def test_table_characters(tmp_path):
+    content = b"Timestamp,Motion,BPM,Meta\n0,12.5,60,0\n,3.25,?,1\n,-1,,\n"
+    assert _read_packed(tmp_path, content)[0] == content
+
+
+def test_escaped_bytes(tmp_path):
+    # every byte outside of the table is escaped in 3 nibbles
+    content = bytes(range(256)) + b"Timestamp,Motion\r\n\xff\x00"
+    assert _read_packed(tmp_path, content)[0] == content
+
+
+def test_odd_number_of_nibbles(tmp_path):
+    # 3 table characters and an escape fill 3 and a half bytes
+    for content in [b"1", b"12,", b"12,T", b"T"]:
+        assert _read_packed(tmp_path, content)[0] == content
+
+
+def test_chunk_ending_on_escape(tmp_path):
+    # the 64 byte chunks of the watch end on an escaped byte, then on the
+    # first nibble of an odd count
+    content = (b"0" * 63 + b"T") * 3 + b"1" * 63 + b"Ti,"
+    received, chunks = _read_packed(tmp_path, content, max_chunk=64)
+    assert chunks == 5
+    assert received == content
@@ -0,0 +1,171 @@
+"""
+pulls from FakeWatchTransport that get interrupted: the download goes to a
+.part file that is resumed by the next pull and only renamed once its
+checksum matches the remote file, and the chunk size backs off while the
+watch runs out of memory
+"""
+
+import re
+import json
+
+from synthetic_nights import generate_night
+from watch_transport import FakeWatchTransport
+from pull_sleep_data import download_sleep_data, PART_SUFFIX, STATS_NAME, _MAX_STALLS
+from pull_index import PullIndex
+
+NAME = "1700000000_120_1.csv"
+
+
+class _Outcomes:
+    """stand-in for the random generator of FakeWatchTransport: the base64
+    encodings fail as listed, then all succeed"""
+    def __init__(self, fails):
+        self.fails = iter(fails)
+
+    def random(self):
+        return 0.0 if next(self.fails, False) else 1.0
+
+
+def _pull(remote, local, fails=None, max_chunk_size=64, chunk_sizes=None, **watch_settings):
+    """pull remote into local once, the encodings failing as listed if
+    fails is given. The chunk size of each transfer is appended to
+    chunk_sizes"""
+    def transport(device):
+        # the listed failures need error_rate to be set
+        settings = {"latency": 0, "error_rate": 0.0 if fails is None else 0.5, **watch_settings}
+        watch = FakeWatchTransport(remote, **settings)
+        if fails is not None:
+            watch.random = _Outcomes(fails)
+        if chunk_sizes is not None:
+            watch.exec = _record_chunk_sizes(watch.exec, chunk_sizes)
+        return watch
+    return download_sleep_data(local_dir=str(local),
+                               device="fake",
+                               delete_after_dl=False,
+                               max_chunk_size=max_chunk_size,
+                               notify=False,
+                               transport=transport)
+
+
+def _record_chunk_sizes(exec, chunk_sizes):
+    "exec of the watch appending the chunk size of each transfer"
+    def recording(code):
+        call = re.search(r'_sleeptk_read\("[^"]*", \d+, \d+, (\d+)', code)
+        if call:
+            chunk_sizes.append(int(call.group(1)))
+        return exec(code)
+    return recording
+
+
+def _last_stats(local):
+    "statistics of the last pull"
+    return json.loads((local / STATS_NAME).read_text().splitlines()[-1])
+
+
+def _dirs(tmp_path, n_rows=60):
+    "the directories of the watch and of the computer, and the remote log"
+    remote, local = tmp_path / "remote", tmp_path / "local"
+    remote.mkdir()
+    return remote, local, generate_night(remote, 1700000000, n_rows)
+
+
+def test_resume(tmp_path):
+    remote, local, log = _dirs(tmp_path)
+    part = local / (NAME + PART_SUFFIX)
+
+    # 3 chunks of 64 bytes, then the watch keeps failing
+    puller = _pull(remote, local, fails=[False] * 3 + [True] * 100)
+    assert puller.status == "failed"
+    assert not (local / NAME).exists()
+    assert part.read_bytes() == log.read_bytes()[:3 * 64]
+
+    # only the missing bytes are pulled
+    puller = _pull(remote, local)
+    assert puller.status == "done"
+    assert (local / NAME).read_bytes() == log.read_bytes()
+    assert not part.exists()
+    assert _last_stats(local)["bytes"] == log.stat().st_size - 3 * 64
+    assert PullIndex(local).is_synced(NAME, log.stat().st_size)
+
+
+def test_remote_grew(tmp_path):
+    remote, local, log = _dirs(tmp_path)
+    _pull(remote, local)
+    old = log.read_bytes()
+    with open(log, "a") as f:
+        f.write("\n,0.125,60,\n,0.250,,")
+
+    # the verified copy is kept while the longer log can not be pulled
+    puller = _pull(remote, local, fails=[True] * 100)
+    assert puller.status == "failed"
+    assert (local / NAME).read_bytes() == old
+    assert (local / (NAME + PART_SUFFIX)).read_bytes() == old
+
+    # then only the new rows are pulled
+    _pull(remote, local)
+    assert (local / NAME).read_bytes() == log.read_bytes()
+    assert not (local / (NAME + PART_SUFFIX)).exists()
+    assert _last_stats(local)["bytes"] == log.stat().st_size - len(old)
+
+
+def test_checksum_mismatch(tmp_path):
+    remote, local, log = _dirs(tmp_path)
+    local.mkdir()
+    part = local / (NAME + PART_SUFFIX)
+
+    # a complete .part with a different content is deleted, not renamed
+    part.write_bytes(log.read_bytes().replace(b"Motion", b"Mution"))
+    puller = _pull(remote, local)
+    assert puller.status == "failed"
+    assert not part.exists()
+    assert not (local / NAME).exists()
+    assert not PullIndex(local).is_synced(NAME, log.stat().st_size)
+
+    # same for a damaged .part that is resumed
+    part.write_bytes(log.read_bytes()[:100].replace(b"Motion", b"Mution"))
+    puller = _pull(remote, local)
+    assert puller.status == "failed"
+    assert not part.exists()
+    assert not (local / NAME).exists()
+
+    # the next pull starts from scratch
+    puller = _pull(remote, local)
+    assert puller.status == "done"
+    assert (local / NAME).read_bytes() == log.read_bytes()
+
+
+def test_backoff_gives_up(tmp_path):
+    remote, local, log = _dirs(tmp_path)
+    chunk_sizes = []
+    puller = _pull(remote, local, max_chunk_size=2048, chunk_sizes=chunk_sizes, max_alloc=10)
+    assert puller.status == "failed"
+    assert chunk_sizes == [2048, 1024, 512, 256, 128][:_MAX_STALLS]
+    assert not (local / NAME).exists()
+
+
+def test_progress_resets_stalls(tmp_path):
+    # a single chunk goes through before each failure
+    remote, local, log = _dirs(tmp_path)
+    chunk_sizes = []
+    puller = _pull(remote, local, fails=[False, True] * 100, chunk_sizes=chunk_sizes)
+    assert puller.status == "done"
+    assert len(chunk_sizes) > _MAX_STALLS
+    assert set(chunk_sizes) == {64}
+    assert (local / NAME).read_bytes() == log.read_bytes()
+
+
+def test_chunk_size_grows_back(tmp_path):
+    remote, local, log = _dirs(tmp_path, n_rows=200)
+    chunk_sizes = []
+    _pull(remote, local, max_chunk_size=256, fails=[True] + [False] * 4 + [True], chunk_sizes=chunk_sizes)
+    # halved by the first failure, doubled after 4 chunks then halved again
+    assert chunk_sizes == [256, 128, 128]
+    assert (local / NAME).read_bytes() == log.read_bytes()
+
+
+def test_flaky_fragmented_watch(tmp_path):
+    remote, local, log = _dirs(tmp_path, n_rows=200)
+    puller = _pull(remote, local, max_chunk_size=2048, error_rate=0.3, max_alloc=300, seed=0)
+    assert puller.status == "done"
+    assert puller.retries > 0
+    assert (local / NAME).read_bytes() == log.read_bytes()
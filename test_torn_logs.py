@@ -0,0 +1,71 @@
+"""
+night_loader and log_reader on a version 2 log damaged like on the watch: a
+last row cut short by a reset and a corrupted row in the middle
+"""
+
+import numpy as np
+import pytest
+
+from synthetic_nights import generate_night
+from night_loader import load_night
+from log_reader import read_epochs, to_arrays
+
+N_ROWS = 200
+
+
+@pytest.fixture
+def damaged_log(tmp_path):
+    """path of the damaged log and the DataFrame of the same night without
+    the two damaged rows"""
+    (tmp_path / "clean").mkdir()
+    clean = load_night(generate_night(tmp_path / "clean", 1700000000, N_ROWS, version=2, seed=3))
+    path = generate_night(tmp_path, 1700000000, N_ROWS, version=2, seed=3, torn=True)
+    lines = path.read_text().split("\n")
+    assert lines[-1], "the torn row must not be empty"
+
+    # a middle row with an elided timestamp, so that the rows after it keep
+    # their timestamp
+    middle = next(i for i in range(N_ROWS // 2, N_ROWS) if lines[i].startswith(","))
+    digit = lines[middle].index(".") - 1
+    lines[middle] = (lines[middle][:digit]
+                     + str((int(lines[middle][digit]) + 1) % 10)
+                     + lines[middle][digit + 1:])
+    path.write_text("\n".join(lines))
+
+    # the header is not a row of the DataFrame
+    expected = clean.drop(index=[middle - 1, N_ROWS - 1]).reset_index(drop=True)
+    return path, expected
+
+
+def test_night_loader(damaged_log):
+    path, expected = damaged_log
+    df = load_night(path)
+    assert df.attrs["corrupt"] == 2
+    for col in ["Timestamp", "Motion", "BPM", "BPM_invalid", "Meta", "UNIX_time"]:
+        assert df[col].equals(expected[col]), col
+
+
+def test_readers_agree(damaged_log):
+    path, _ = damaged_log
+    df = load_night(path)
+    epochs = list(read_epochs(path))
+    arrays = to_arrays(path)
+
+    # the damaged rows are dropped by all the readers
+    assert N_ROWS - len(epochs) == df.attrs["corrupt"]
+    assert N_ROWS - len(arrays["timestamp"]) == df.attrs["corrupt"]
+
+    assert [e.timestamp for e in epochs] == df["Timestamp"].tolist()
+    assert [e.unix_time for e in epochs] == df["UNIX_time"].tolist()
+    assert [e.motion for e in epochs] == df["Motion"].tolist()
+    assert [e.bpm_invalid for e in epochs] == df["BPM_invalid"].tolist()
+    assert [e.meta for e in epochs] == df["Meta"].astype(int).tolist()
+    bpm = np.array([np.nan if e.bpm is None else e.bpm for e in epochs])
+    np.testing.assert_array_equal(bpm, df["BPM"].to_numpy())
+
+    np.testing.assert_array_equal(arrays["timestamp"], df["Timestamp"].to_numpy())
+    np.testing.assert_array_equal(arrays["unix_time"], df["UNIX_time"].to_numpy())
+    np.testing.assert_array_equal(arrays["motion"], df["Motion"].to_numpy())
+    np.testing.assert_array_equal(arrays["bpm"], df["BPM"].to_numpy())
+    np.testing.assert_array_equal(arrays["bpm_invalid"], df["BPM_invalid"].to_numpy())
+    np.testing.assert_array_equal(arrays["meta"], df["Meta"].astype(int).to_numpy())
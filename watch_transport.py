@@ -0,0 +1,218 @@
+"""
+ways to talk to the watch: through wasptool for a real pinetime, or to a
+simulated watch serving a local directory, used to test and time the pull
+pipeline without a watch
+"""
+
+import time
+import random
+import subprocess
+import shlex
+import tempfile
+import threading
+import binascii
+import builtins
+import os
+from pathlib import Path
+from types import SimpleNamespace
+
+# "bluetooth on" only has to be run once per process, even in fleet mode
+_bluetooth_lock = threading.Lock()
+_bluetooth_ready = False
+
+
+def _bluetooth_on():
+    "turn on the bluetooth adapter and give it a few seconds to start"
+    global _bluetooth_ready
+    with _bluetooth_lock:
+        if not _bluetooth_ready:
+            subprocess.check_output(
+                shlex.split(
+                    'bluetooth on')).decode()
+            time.sleep(3)
+            _bluetooth_ready = True
+
+
+class WatchError(Exception):
+    "error reported by the watch, keeps the output that was received so far"
+    def __init__(self, message, out=""):
+        super().__init__(message)
+        self.out = out
+
+
+class WasptoolTransport:
+    """
+    runs code on a real watch using wasptool
+    """
+    remote_dir = "/flash/logs/sleep/"
+
+    def __init__(self, device, wasptool="./tools/wasptool"):
+        self.device = device
+        self.wasptool = wasptool
+
+    def prepare(self):
+        "make sure the bluetooth adapter is ready"
+        _bluetooth_on()
+
+    def battery(self):
+        "ask for the battery level, raises if the watch is not reachable"
+        return subprocess.check_output(
+            shlex.split(
+                f'{self.wasptool} --device {self.device} --verbose --battery')).decode()
+
+    def eval(self, code):
+        "evaluate a single line of python on the watch and return its output"
+        return subprocess.check_output(
+            [*shlex.split(f'{self.wasptool} --device {self.device} --verbose --eval'), code]
+            ).decode()
+
+    def exec(self, code):
+        "run a snippet of python code on the watch and return its output"
+        with tempfile.NamedTemporaryFile("w", suffix=".py") as f:
+            f.write(code)
+            f.flush()
+            proc = subprocess.run(
+                shlex.split(
+                    f'{self.wasptool} --device {self.device} --verbose --exec "{f.name}"'
+                    ),
+                stdout=subprocess.PIPE)
+        out = proc.stdout.decode(errors="replace")
+        if "MemoryError" in out:
+            raise WatchError("Memory error from watch.", out)
+        if "Traceback" in out:
+            raise WatchError(f"Watch reported error: '{out}'", out)
+        if proc.returncode != 0:
+            raise WatchError(f"wasptool exited with code {proc.returncode}", out)
+        return out
+
+
+class FakeWatchTransport:
+    """
+    simulated watch serving the files of a local directory as if they were
+    its sleep logs. The code sent to it is run by CPython with stand-ins
+    for the few micropython modules it uses, and every call waits to mimic
+    the bluetooth link.
+    """
+    def __init__(self,
+                 root,
+                 latency=0.2,
+                 throughput=None,
+                 mem_free=20000,
+                 max_alloc=None,
+                 error_rate=0.0,
+                 tracking=False,
+                 present=True,
+                 seed=None,
+                 ):
+        """
+        Parameters
+        ----------
+        root: str
+            directory whose files act as the content of /flash/logs/sleep/
+        latency: float, default 0.2
+            seconds spent on every call, like the connection of wasptool
+        throughput: int, default None
+            bytes per second of output sent back by the watch, None to
+            disable the limit
+        mem_free: int, default 20000
+            value returned by gc.mem_free()
+        max_alloc: int, default None
+            base64 encoding more than that many bytes at once raises a
+            MemoryError, like a fragmented heap would
+        error_rate: float, default 0.0
+            probability for each base64 encoding to raise a MemoryError
+        tracking: bool, default False
+            if True, pretend SleepTk is currently tracking
+        present: bool, default True
+            if False, pretend the watch is out of range
+        """
+        self.remote_dir = str(Path(root).absolute()) + "/"
+        self.device = f"fake:{root}"
+        self.latency = latency
+        self.throughput = throughput
+        self.mem_free = mem_free
+        self.max_alloc = max_alloc
+        self.error_rate = error_rate
+        self.tracking = tracking
+        self.present = present
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.bytes_sent = 0
+        self.settings = {}  # stored by wasp.system.set
+
+    def prepare(self):
+        pass
+
+    def battery(self):
+        self._wait("")
+        if not self.present:
+            raise Exception("Fake watch is out of range")
+        return "Battery: 80%"
+
+    def eval(self, code):
+        return self.exec(code)
+
+    def exec(self, code):
+        out = []
+        env = self._environment(out)
+        error = None
+        try:
+            exec(code, env)
+        except MemoryError:
+            out.append("Traceback (most recent call last):\nMemoryError: memory allocation failed\n")
+            error = WatchError("Memory error from watch.")
+        except Exception as err:
+            out.append(f"Traceback (most recent call last):\n{type(err).__name__}: {err}\n")
+            error = WatchError(f"Watch reported error: '{err}'")
+        out = "".join(out)
+        self._wait(out)
+        if error is not None:
+            error.out = out
+            raise error
+        return out
+
+    def _wait(self, out):
+        "mimic the time taken by the bluetooth link"
+        if not self.present:
+            raise WatchError("Fake watch is out of range")
+        self.calls += 1
+        self.bytes_sent += len(out)
+        delay = self.latency
+        if self.throughput:
+            delay += len(out) / self.throughput
+        time.sleep(delay)
+
+    def _environment(self, out):
+        "globals used to run code as if it were sent to the watch"
+        def fake_print(*args, sep=" ", end="\n"):
+            out.append(sep.join(str(a) for a in args) + end)
+
+        def b2a_base64(data):
+            if self.max_alloc is not None and len(data) > self.max_alloc:
+                raise MemoryError()
+            if self.error_rate and self.random.random() < self.error_rate:
+                raise MemoryError()
+            return binascii.b2a_base64(data)
+
+        modules = {
+            "gc": SimpleNamespace(collect=lambda: None,
+                                  mem_free=lambda: self.mem_free),
+            "ubinascii": SimpleNamespace(b2a_base64=b2a_base64),
+            "shell": SimpleNamespace(rm=os.remove),
+            "os": os,
+        }
+        wasp = SimpleNamespace(gc=modules["gc"],
+                               system=SimpleNamespace(get=self.settings.get,
+                                                      set=self.settings.__setitem__))
+        if self.tracking:
+            wasp._SleepTk_tracking = 1
+
+        def fake_import(name, *args, **kwargs):
+            if name in modules:
+                return modules[name]
+            raise ImportError(f"No module named '{name}' on the fake watch")
+
+        fake_builtins = dict(vars(builtins))
+        fake_builtins["print"] = fake_print
+        fake_builtins["__import__"] = fake_import
+        return {"__builtins__": fake_builtins, "wasp": wasp}